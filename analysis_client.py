@@ -0,0 +1,216 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from azure.ai.formrecognizer import AnalyzeResult, AnalysisFeature
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+
+# Codici HTTP per cui ha senso riprovare (throttling e indisponibilità temporanea)
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# prebuilt-document restituisce sempre le coppie chiave-valore; gli altri modelli (es. prebuilt-invoice)
+# solo se richieste come funzionalità aggiuntiva (API 2023-07-31)
+KEY_VALUE_NATIVE_MODELS = {'prebuilt-document'}
+
+
+class AnalysisThrottledError(Exception):
+    """Form Recognizer ha rifiutato la richiesta anche dopo tutti i tentativi (quota esaurita)"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Limita le richieste al secondo: 'rate' token al secondo, al massimo 'capacity' accumulati"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def penalize(self, seconds):
+        """Dopo un 429 svuota il secchio: nessuna richiesta parte prima di 'seconds'"""
+        self._tokens = min(self._tokens, -seconds * self.rate + 1)
+        self._updated = time.monotonic()
+
+
+def parse_retry_after(headers):
+    """Secondi di attesa suggeriti dal servizio (retry-after-ms, x-ms-retry-after-ms o Retry-After)"""
+    if not headers:
+        return None
+    for header in ('retry-after-ms', 'x-ms-retry-after-ms'):
+        value = headers.get(header)
+        if value:
+            try:
+                return float(value) / 1000
+            except ValueError:
+                pass
+
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        # Retry-After può essere anche una data HTTP
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def merge_analyze_results(first, second):
+    """Unisce le analisi di due intervalli di pagine dello stesso documento.
+
+    Gli offset (spans) della seconda analisi restano relativi al suo contenuto:
+    l'estrazione dei campi usa solo testo, coppie chiave-valore, tabelle e documenti.
+    """
+    merged = first.to_dict()
+    extra = second.to_dict()
+    for key in ('pages', 'paragraphs', 'tables', 'key_value_pairs', 'documents', 'styles', 'languages'):
+        merged[key] = (merged.get(key) or []) + (extra.get(key) or [])
+    merged['content'] = '\n'.join(part for part in (merged.get('content'), extra.get('content')) if part)
+    return AnalyzeResult.from_dict(merged)
+
+
+class _LoopThread:
+    """Event loop in un thread dedicato, per usare il client asincrono da codice sincrono"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='form-recognizer-loop', daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+class AnalysisClient:
+    """Client asincrono di Form Recognizer con concorrenza limitata, rate limiting e retry.
+
+    Le chiamate sincrone (app Flask, job in background, strumenti bulk) passano tutte
+    dallo stesso event loop del processo, quindi condividono semaforo e token bucket.
+    """
+
+    def __init__(self, endpoint, key, max_concurrency=None, tps=None, max_retries=None,
+                 backoff_base=1.0, backoff_max=60.0):
+        self.endpoint = endpoint
+        self.key = key
+        self.max_concurrency = max_concurrency or int(os.getenv('FORM_RECOGNIZER_MAX_CONCURRENCY', 4))
+        # 15 TPS è il limite del tier S0 di Form Recognizer
+        self.tps = tps or float(os.getenv('FORM_RECOGNIZER_TPS', 15))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('FORM_RECOGNIZER_MAX_RETRIES', 5))
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        # Client, semaforo e token bucket sono legati all'event loop che li usa
+        self._loop_state = {}
+        self._loop_thread = None
+        self._loop_pid = None
+        self._loop_lock = threading.Lock()
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        state = self._loop_state.get(loop)
+        if state is None:
+            state = {
+                # Retry gestiti qui: il client dell'SDK non deve riprovare per conto suo
+                'client': DocumentAnalysisClient(
+                    endpoint=self.endpoint,
+                    credential=AzureKeyCredential(self.key),
+                    retry_total=0
+                ),
+                'semaphore': asyncio.Semaphore(self.max_concurrency),
+                'bucket': TokenBucket(self.tps)
+            }
+            self._loop_state[loop] = state
+        return state
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after
+        # Backoff esponenziale con jitter per non riprovare tutti nello stesso istante
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def analyze(self, document, model_id='prebuilt-document', **kwargs):
+        """Analizza un documento (bytes) e ritorna l'AnalyzeResult"""
+        if model_id not in KEY_VALUE_NATIVE_MODELS:
+            kwargs.setdefault('features', [AnalysisFeature.KEY_VALUE_PAIRS])
+        state = self._state()
+        retry_after = None
+
+        for attempt in range(self.max_retries + 1):
+            async with state['semaphore']:
+                await state['bucket'].acquire()
+                try:
+                    poller = await state['client'].begin_analyze_document(model_id, document, **kwargs)
+                    return await poller.result()
+                except HttpResponseError as e:
+                    if e.status_code not in RETRYABLE_STATUS_CODES:
+                        raise
+                    retry_after = parse_retry_after(e.response.headers if e.response else None)
+                    if e.status_code == 429:
+                        state['bucket'].penalize(retry_after or self._backoff(attempt))
+                except (ServiceRequestError, ServiceResponseError):
+                    retry_after = None
+
+            if attempt < self.max_retries:
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+
+        raise AnalysisThrottledError(
+            f"Form Recognizer non disponibile dopo {self.max_retries + 1} tentativi",
+            retry_after=retry_after or self.backoff_max
+        )
+
+    async def analyze_many(self, documents, model_id='prebuilt-document', **kwargs):
+        """Analizza più documenti in parallelo (entro i limiti di concorrenza e TPS).
+
+        Ritorna una lista allineata ai documenti con AnalyzeResult o l'eccezione del singolo documento.
+        """
+        return await asyncio.gather(
+            *(self.analyze(document, model_id, **kwargs) for document in documents),
+            return_exceptions=True
+        )
+
+    async def close(self):
+        state = self._loop_state.pop(asyncio.get_running_loop(), None)
+        if state:
+            await state['client'].close()
+
+    def _background_loop(self):
+        with self._loop_lock:
+            # Dopo un fork (pool di processi) il thread del loop non esiste più
+            if self._loop_thread is None or self._loop_pid != os.getpid():
+                self._loop_state = {}
+                self._loop_thread = _LoopThread()
+                self._loop_pid = os.getpid()
+            return self._loop_thread
+
+    def analyze_sync(self, document, model_id='prebuilt-document', **kwargs):
+        """Versione sincrona di analyze, per Flask e per i worker della coda"""
+        return self._background_loop().run(self.analyze(document, model_id, **kwargs))
+
+    def analyze_many_sync(self, documents, model_id='prebuilt-document', **kwargs):
+        """Versione sincrona di analyze_many, per gli strumenti bulk"""
+        return self._background_loop().run(self.analyze_many(documents, model_id, **kwargs))
@@ -1,15 +1,28 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response, stream_with_context
 import os
 import time
 import io
+import json
+import math
 import hashlib
-from datetime import datetime
+import tempfile
+import zipfile
+import unicodedata
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from werkzeug.utils import secure_filename
+from werkzeug.http import http_date, unquote_etag, dump_options_header
+from azure.core import MatchConditions
 from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
 from dotenv import load_dotenv
 import msal
 from functools import wraps
-from bill_processor import bill_processor
+from bill_processor import bill_processor, BILL_LIST_FIELDS, FIELD_NAME_PATTERN
+from job_queue import job_queue, RetryJob
+from analysis_client import AnalysisThrottledError
+from file_index import file_index
+from bill_forecast import MAX_MONTHS_AHEAD
+from forecast_models import MODELS, AUTO_MODEL, MIN_TRAIN_POINTS, model_names
 
 load_dotenv()
 TESTING = os.getenv('TESTING', 'False').lower() == 'true'
@@ -36,6 +49,20 @@ AZURE_B2C_SCOPES = []
 AZURE_STORAGE_CONNECTION_STRING = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
 AZURE_CONTAINER_NAME = os.getenv('AZURE_BLOB_CONTAINER_NAME')
 
+# Dimensione dei blocchi scaricati da Azure e inoltrati al client durante il download
+AZURE_BLOB_STREAM_CHUNK_SIZE = int(os.getenv('AZURE_BLOB_STREAM_CHUNK_SIZE', 1024 * 1024))
+
+# Cartella locale dove i PDF attendono l'estrazione in background
+JOBS_SPOOL_DIR = os.getenv('JOBS_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'smartbills_spool'))
+
+# Numero massimo di file caricati/elaborati in parallelo per ogni upload multiplo
+BATCH_UPLOAD_WORKERS = int(os.getenv('BATCH_UPLOAD_WORKERS', 8))
+
+# Limiti degli archivi ZIP (protezione da zip bomb): numero di file, dimensione decompressa per file e totale
+BATCH_ZIP_MAX_MEMBERS = int(os.getenv('BATCH_ZIP_MAX_MEMBERS', 200))
+BATCH_ZIP_MAX_FILE_SIZE = int(os.getenv('BATCH_ZIP_MAX_FILE_SIZE', 16 * 1024 * 1024))
+BATCH_ZIP_MAX_TOTAL_SIZE = int(os.getenv('BATCH_ZIP_MAX_TOTAL_SIZE', 128 * 1024 * 1024))
+
 # Verifica configurazioni Azure AD B2C
 azure_b2c_configured = bool(AZURE_B2C_CLIENT_ID and AZURE_B2C_CLIENT_SECRET and AZURE_B2C_TENANT_ID and AZURE_B2C_AUTHORITY)
 if not azure_b2c_configured:
@@ -52,7 +79,12 @@ elif not AZURE_STORAGE_CONNECTION_STRING or AZURE_STORAGE_CONNECTION_STRING == '
 else:
     try:
         # Inizializza Azure Blob Service Client
-        blob_service_client = BlobServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
+        # Blocchi piccoli: il download in streaming inizia a rispondere dopo il primo blocco
+        blob_service_client = BlobServiceClient.from_connection_string(
+            AZURE_STORAGE_CONNECTION_STRING,
+            max_single_get_size=AZURE_BLOB_STREAM_CHUNK_SIZE,
+            max_chunk_get_size=AZURE_BLOB_STREAM_CHUNK_SIZE
+        )
         container_client = blob_service_client.get_container_client(AZURE_CONTAINER_NAME)
         # Crea il container se non esiste
         try:
@@ -166,6 +198,10 @@ def upload_file_to_azure(file, filename, user_folder=None):
         
         # Ottieni le proprietà del blob
         blob_properties = blob_client.get_blob_properties()
+        
+        # Aggiorna l'indice dei file dell'utente senza rileggere lo storage
+        file_index.add_file(user_folder or '', build_file_info(filename, blob_name, blob_properties))
+        
         return {
             'success': True,
             'size': blob_properties.size,
@@ -178,8 +214,12 @@ def upload_file_to_azure(file, filename, user_folder=None):
             'error': str(e)
         }
 
-def download_file_from_azure(filename, user_folder=None):
-    """Scarica un file da Azure Blob Storage dalla cartella dell'utente"""
+def download_file_from_azure(filename, user_folder=None, offset=None, length=None, etag=None):
+    """Apre un download in streaming da Azure Blob Storage dalla cartella dell'utente.
+    
+    Ritorna lo StorageStreamDownloader (da consumare con .chunks()) o None. Se viene passato
+    l'etag il download fallisce quando il blob è cambiato nel frattempo.
+    """
     if not container_client:
         return None
         
@@ -191,17 +231,26 @@ def download_file_from_azure(filename, user_folder=None):
             blob_name = filename
             
         blob_client = container_client.get_blob_client(blob_name)
-        blob_data = blob_client.download_blob()
-        
-        # Crea un oggetto BytesIO per il download
-        file_stream = io.BytesIO()
-        blob_data.readinto(file_stream)
-        file_stream.seek(0)
-        
-        return file_stream
+        return blob_client.download_blob(
+            offset=offset,
+            length=length,
+            etag=etag,
+            match_condition=MatchConditions.IfNotModified if etag else None
+        )
     except Exception as e:
         return None
 
+def content_disposition(filename):
+    """Intestazione Content-Disposition di un download, come send_file(download_name=...):
+    nome tra virgolette con escape e, per i caratteri non ASCII, anche filename* (RFC 5987)"""
+    try:
+        filename.encode('ascii')
+        names = {'filename': filename}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': simple, 'filename*': f"UTF-8''{quote(filename, safe='!#$&+-.^_`|~')}"}
+    return dump_options_header('attachment', names)
+
 def delete_file_from_azure(filename, user_folder=None):
     """Elimina un file da Azure Blob Storage dalla cartella dell'utente"""
     if not container_client:
@@ -216,10 +265,24 @@ def delete_file_from_azure(filename, user_folder=None):
             
         blob_client = container_client.get_blob_client(blob_name)
         blob_client.delete_blob()
+        file_index.remove_file(user_folder or '', filename)
         return True
     except Exception as e:
         return False
 
+def build_file_info(filename, blob_name, blob_properties):
+    """Costruisce le informazioni di un file dalle proprietà del blob (anche quelle del listing)"""
+    return {
+        'name': filename,
+        'blob_name': blob_name,
+        'size': blob_properties.size,
+        'size_mb': round(blob_properties.size / (1024 * 1024), 2),
+        'upload_time': blob_properties.last_modified.replace(tzinfo=None),
+        'formatted_time': blob_properties.last_modified.strftime('%d/%m/%Y %H:%M:%S'),
+        'etag': blob_properties.etag,
+        'location': 'Azure Blob Storage'
+    }
+
 def get_file_info(filename, user_folder=None):
     """Ottiene informazioni su un file caricato da Azure"""
     if not container_client:
@@ -235,44 +298,56 @@ def get_file_info(filename, user_folder=None):
         blob_client = container_client.get_blob_client(blob_name)
         blob_properties = blob_client.get_blob_properties()
         
-        return {
-            'name': filename,
-            'blob_name': blob_name,
-            'size': blob_properties.size,
-            'size_mb': round(blob_properties.size / (1024 * 1024), 2),
-            'upload_time': blob_properties.last_modified.replace(tzinfo=None),
-            'formatted_time': blob_properties.last_modified.strftime('%d/%m/%Y %H:%M:%S'),
-            'location': 'Azure Blob Storage'
-        }
+        return build_file_info(filename, blob_name, blob_properties)
     except Exception as e:
         return None
 
-def get_uploaded_files(user_folder=None):
+def list_uploaded_files_page(user_folder=None, page_size=100, continuation_token=None):
+    """Elenca una pagina di PDF dell'utente. Ritorna (files, continuation_token della pagina successiva).
+    
+    Il listing è filtrato per prefisso lato Azure e contiene già dimensione e data di modifica,
+    quindi non serve una chiamata get_blob_properties per ogni file.
+    """
+    if not container_client:
+        return [], None
+    
+    prefix = f"{user_folder}/" if user_folder else None
+    pages = container_client.list_blobs(name_starts_with=prefix, results_per_page=page_size).by_page(
+        continuation_token=continuation_token
+    )
+    page = next(pages, None)
+    if page is None:
+        return [], None
+    
     files = []
+    for blob in page:
+        filename = blob.name[len(prefix):] if prefix else blob.name
+        if filename.lower().endswith('.pdf'):
+            files.append(build_file_info(filename, blob.name, blob))
     
+    return files, pages.continuation_token
+
+def iter_uploaded_files(user_folder=None, page_size=100):
+    """Restituisce i PDF dell'utente pagina per pagina, man mano che arrivano da Azure"""
+    continuation_token = None
+    while True:
+        files, continuation_token = list_uploaded_files_page(user_folder, page_size, continuation_token)
+        yield from files
+        if not continuation_token:
+            break
+
+def get_user_file_index(user_folder=None):
+    """Indice dei file dell'utente ({'files', 'total_size'}), letto dalla cache quando possibile"""
     if not container_client:
-        return files
+        return {'files': [], 'total_size': 0}
     
     try:
-        blob_list = container_client.list_blobs()
-        for blob in blob_list:
-            # Se è specificata una cartella utente, filtra solo i blob di quella cartella
-            if user_folder:
-                if not blob.name.startswith(f"{user_folder}/"):
-                    continue
-                # Estrai il nome del file dalla path completa
-                filename = blob.name[len(f"{user_folder}/"):]
-            else:
-                filename = blob.name
-                
-            if filename.lower().endswith('.pdf'):
-                file_info = get_file_info(filename, user_folder)
-                if file_info:
-                    files.append(file_info)
+        return file_index.get_index(user_folder or '', lambda: list(iter_uploaded_files(user_folder)))
     except Exception as e:
-        pass
-    
-    return sorted(files, key=lambda x: x['upload_time'], reverse=True)
+        return {'files': [], 'total_size': 0}
+
+def get_uploaded_files(user_folder=None):
+    return get_user_file_index(user_folder)['files']
 
 # Route di autenticazione
 @app.route("/login")
@@ -373,6 +448,103 @@ def upload_page():
     return render_template("upload.html", user=user)
 
 
+def _bill_summary(bill_data):
+    """Riassunto dei dati estratti restituito al client"""
+    return {
+        'type': bill_data.get('bill_type'),
+        'supplier': bill_data.get('supplier'),
+        'amount': bill_data.get('amount'),
+        'due_date': bill_data.get('due_date'),
+        'needs_review': bill_data.get('manual_review_needed', False)
+    }
+
+def _describe_bill(bill_data):
+    if bill_data.get('manual_review_needed'):
+        return ' ⚠️ Revisione manuale richiesta per alcuni dati.'
+    
+    bill_type = bill_data.get('bill_type', 'unknown')
+    supplier = bill_data.get('supplier', 'N/D')
+    amount = bill_data.get('amount')
+    description = f' 📄 Tipo: {bill_type.title()}, Fornitore: {supplier}'
+    if amount:
+        description += f', Importo: €{amount:.2f}'
+    return description
+
+def _build_upload_message(filename, bill_data):
+    return f'File "{filename}" caricato con successo!' + _describe_bill(bill_data)
+
+def compute_content_hash(file, chunk_size=1024 * 1024):
+    """SHA-256 del contenuto del file, letto a blocchi"""
+    content_hash = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        content_hash.update(chunk)
+    file.seek(0)
+    return content_hash.hexdigest()
+
+def find_duplicate_upload(user, content_hash):
+    """Bolletta già estratta dallo stesso PDF, se il file è ancora nell'area dell'utente"""
+    bill = bill_processor.find_bill_by_hash(user['id'], content_hash)
+    if bill and get_file_info(bill['filename'], user['folder']):
+        return bill
+    return None
+
+def _build_duplicate_message(bill):
+    return f'File già caricato come "{bill["filename"]}": dati recuperati senza una nuova analisi.' + _describe_bill(bill)
+
+def process_extraction_job(payload, last_attempt=True):
+    """Esegue in background l'estrazione dati di un PDF caricato"""
+    spool_path = payload['spool_path']
+    keep_spool = False
+    try:
+        with open(spool_path, 'rb') as pdf_stream:
+            bill_data = bill_processor.extract_bill_data(
+                pdf_stream,
+                payload['filename'],
+                payload['user_id'],
+                content_hash=payload.get('content_hash')
+            )
+    except AnalysisThrottledError as e:
+        # Quota OCR esaurita: il job torna in coda e il PDF resta nello spool
+        keep_spool = not last_attempt
+        raise RetryJob(str(e), delay=e.retry_after or 60)
+    finally:
+        if not keep_spool:
+            try:
+                os.remove(spool_path)
+            except OSError:
+                pass
+
+    return {
+        'filename': payload['filename'],
+        'message': _build_upload_message(payload['filename'], bill_data),
+        'bill_data': _bill_summary(bill_data)
+    }
+
+job_queue.register('extract_bill', process_extraction_job)
+
+@app.before_request
+def start_job_queue():
+    # Worker avviati nel processo che serve le richieste (non all'import: con gunicorn --preload
+    # i thread del master non sopravvivono al fork); i job rimasti in coda ripartono subito
+    job_queue.start()
+
+def enqueue_extraction(file, filename, user_id, content_hash=None):
+    """Salva il PDF nella cartella di spool e accoda l'estrazione"""
+    os.makedirs(JOBS_SPOOL_DIR, exist_ok=True)
+    fd, spool_path = tempfile.mkstemp(dir=JOBS_SPOOL_DIR, suffix='.pdf')
+    file.seek(0)  # Reset del puntatore del file
+    with os.fdopen(fd, 'wb') as spool_file:
+        spool_file.write(file.read())
+
+    return job_queue.enqueue('extract_bill', {
+        'spool_path': spool_path,
+        'filename': filename,
+        'user_id': user_id,
+        'content_hash': content_hash
+    }, user_id=user_id)
+
+
 @app.route("/upload", methods=['POST'])
 @login_required
 def upload_file():
@@ -393,6 +565,19 @@ def upload_file():
             return jsonify({'success': False, 'error': 'Nessun file selezionato'})
         
         if file and allowed_file(file.filename):
+            # Stesso PDF già caricato: niente nuovo upload né nuova analisi
+            content_hash = compute_content_hash(file)
+            duplicate = find_duplicate_upload(user, content_hash)
+            if duplicate:
+                return jsonify({
+                    'success': True,
+                    'duplicate': True,
+                    'message': _build_duplicate_message(duplicate),
+                    'filename': duplicate['filename'],
+                    'storage': 'azure',
+                    'bill_data': _bill_summary(duplicate)
+                })
+            
             # Crea un nome file sicuro con timestamp
             filename = secure_filename(file.filename)
             timestamp = str(int(time.time()))
@@ -403,39 +588,17 @@ def upload_file():
             upload_result = upload_file_to_azure(file, filename, user['folder'])
             
             if upload_result['success']:
-                # Processa la bolletta per estrarre i dati
+                # L'estrazione dati avviene in background: il client interroga lo stato del job
                 try:
-                    file.seek(0)  # Reset del puntatore del file
-                    bill_data = bill_processor.extract_bill_data(
-                        file, 
-                        filename, 
-                        user['id']
-                    )
-                    
-                    message = f'File "{filename}" caricato con successo!'
-                    if bill_data.get('manual_review_needed'):
-                        message += ' ⚠️ Revisione manuale richiesta per alcuni dati.'
-                    else:
-                        bill_type = bill_data.get('bill_type', 'unknown')
-                        supplier = bill_data.get('supplier', 'N/D')
-                        amount = bill_data.get('amount')
-                        message += f' 📄 Tipo: {bill_type.title()}, Fornitore: {supplier}'
-                        if amount:
-                            message += f', Importo: €{amount:.2f}'
-                    
+                    job_id = enqueue_extraction(file, filename, user['id'], content_hash)
                     return jsonify({
                         'success': True, 
-                        'message': message,
+                        'message': f'File "{filename}" caricato con successo! Estrazione dati in corso...',
                         'filename': filename,
                         'storage': 'azure',
-                        'bill_data': {
-                            'type': bill_data.get('bill_type'),
-                            'supplier': bill_data.get('supplier'),
-                            'amount': bill_data.get('amount'),
-                            'due_date': bill_data.get('due_date'),
-                            'needs_review': bill_data.get('manual_review_needed', False)
-                        }
-                    })
+                        'job_id': job_id,
+                        'status_url': url_for('api_job_status', job_id=job_id)
+                    }), 202
                 except Exception as e:
                     return jsonify({
                         'success': True, 
@@ -452,20 +615,197 @@ def upload_file():
         return jsonify({'success': False, 'error': f'Errore durante l\'upload: {str(e)}'})
 
 
+def is_pdf_data(data):
+    """Controlla la firma %PDF (ammessa entro i primi 1024 byte) invece dell'estensione"""
+    return b'%PDF-' in data[:1024]
+
+def read_zip_member(archive, member, limit):
+    """Legge un file dell'archivio fermandosi oltre 'limit' byte decompressi (None se li supera).
+
+    La dimensione dichiarata nell'intestazione può essere falsa: conta quella effettiva.
+    """
+    with archive.open(member) as source:
+        data = source.read(limit + 1)
+    return data if len(data) <= limit else None
+
+def collect_zip_files(uploaded, pdf_files, errors):
+    """Aggiunge i PDF di un archivio ZIP rispettando i limiti di numero e dimensione"""
+    def reject(name, message):
+        errors.append({'original_name': name, 'success': False, 'error': message})
+    
+    with zipfile.ZipFile(uploaded) as archive:
+        members = [
+            member for member in archive.infolist()
+            # Salta cartelle e metadati di macOS
+            if not member.is_dir() and not member.filename.startswith('__MACOSX/')
+            and allowed_file(os.path.basename(member.filename))
+        ]
+        if len(members) > BATCH_ZIP_MAX_MEMBERS:
+            reject(uploaded.filename, f'Troppi file nell\'archivio (massimo {BATCH_ZIP_MAX_MEMBERS})')
+            return
+        
+        total_size = 0
+        for member in members:
+            member_name = os.path.basename(member.filename)
+            limit = min(BATCH_ZIP_MAX_FILE_SIZE, BATCH_ZIP_MAX_TOTAL_SIZE - total_size)
+            if member.file_size > limit:
+                reject(member_name, 'File troppo grande una volta decompresso')
+                continue
+            
+            data = read_zip_member(archive, member, limit)
+            if data is None:
+                reject(member_name, 'File troppo grande una volta decompresso')
+                continue
+            total_size += len(data)
+            
+            if not is_pdf_data(data):
+                reject(member_name, 'Il file non è un PDF valido')
+                continue
+            pdf_files.append((member_name, data))
+
+def collect_batch_files(uploaded_files):
+    """Estrae dai file ricevuti (PDF o archivi ZIP) la lista di PDF da elaborare"""
+    pdf_files = []
+    errors = []
+    
+    for uploaded in uploaded_files:
+        if not uploaded or uploaded.filename == '':
+            continue
+        
+        if uploaded.filename.lower().endswith('.zip'):
+            try:
+                collect_zip_files(uploaded, pdf_files, errors)
+            except (zipfile.BadZipFile, zipfile.LargeZipFile, NotImplementedError, RuntimeError):
+                errors.append({'original_name': uploaded.filename, 'success': False, 'error': 'Archivio ZIP non valido'})
+        elif allowed_file(uploaded.filename):
+            data = uploaded.read()
+            if is_pdf_data(data):
+                pdf_files.append((uploaded.filename, data))
+            else:
+                errors.append({'original_name': uploaded.filename, 'success': False, 'error': 'Il file non è un PDF valido'})
+        else:
+            errors.append({'original_name': uploaded.filename, 'success': False, 'error': 'Solo file PDF o ZIP sono ammessi'})
+    
+    return pdf_files, errors
+
+def process_batch_file(original_name, data, filename, user):
+    """Carica un singolo PDF di un upload multiplo ed estrae i dati"""
+    content_hash = hashlib.sha256(data).hexdigest()
+    duplicate = find_duplicate_upload(user, content_hash)
+    if duplicate:
+        return {
+            'original_name': original_name,
+            'success': True,
+            'duplicate': True,
+            'filename': duplicate['filename'],
+            'message': _build_duplicate_message(duplicate),
+            'bill_data': _bill_summary(duplicate)
+        }
+    
+    file = io.BytesIO(data)
+    upload_result = upload_file_to_azure(file, filename, user['folder'])
+    if not upload_result['success']:
+        return {'original_name': original_name, 'success': False, 'error': f'Errore durante l\'upload: {upload_result["error"]}'}
+    
+    try:
+        file.seek(0)
+        bill_data = bill_processor.extract_bill_data(file, filename, user['id'], content_hash=content_hash)
+        return {
+            'original_name': original_name,
+            'success': True,
+            'filename': filename,
+            'message': _build_upload_message(filename, bill_data),
+            'bill_data': _bill_summary(bill_data)
+        }
+    except AnalysisThrottledError:
+        # Quota OCR esaurita: il file è già caricato, l'estrazione prosegue in background
+        job_id = enqueue_extraction(file, filename, user['id'], content_hash=content_hash)
+        return {
+            'original_name': original_name,
+            'success': True,
+            'filename': filename,
+            'job_id': job_id,
+            'message': f'File "{filename}" caricato. Estrazione dati in corso...'
+        }
+    except Exception as e:
+        return {
+            'original_name': original_name,
+            'success': True,
+            'filename': filename,
+            'message': f'File "{filename}" caricato, ma errore nell\'estrazione dati: {str(e)}'
+        }
+
+@app.route("/upload/batch", methods=['POST'])
+@login_required
+def upload_batch():
+    """Upload multiplo: PDF e/o archivi ZIP, risultati restituiti file per file in NDJSON"""
+    if not container_client:
+        return jsonify({'success': False, 'error': 'Azure Blob Storage non configurato. Contatta l\'amministratore.'})
+    
+    user = get_current_user()
+    if not user:
+        return jsonify({'success': False, 'error': 'Utente non autenticato'})
+    
+    pdf_files, errors = collect_batch_files(request.files.getlist('files'))
+    if not pdf_files and not errors:
+        return jsonify({'success': False, 'error': 'Nessun file selezionato'})
+    
+    # Nomi file sicuri con timestamp, unici anche all'interno dello stesso upload
+    timestamp = str(int(time.time()))
+    used_names = set()
+    jobs = []
+    for original_name, data in pdf_files:
+        name, ext = os.path.splitext(secure_filename(original_name) or 'bolletta.pdf')
+        filename = f"{name}_{timestamp}{ext}"
+        counter = 1
+        while filename in used_names:
+            filename = f"{name}_{timestamp}_{counter}{ext}"
+            counter += 1
+        used_names.add(filename)
+        jobs.append((original_name, data, filename))
+    
+    def generate():
+        for error in errors:
+            yield json.dumps(error) + '\n'
+        
+        succeeded = 0
+        with ThreadPoolExecutor(max_workers=BATCH_UPLOAD_WORKERS) as executor:
+            futures = [executor.submit(process_batch_file, original_name, data, filename, user)
+                       for original_name, data, filename in jobs]
+            for future in as_completed(futures):
+                result = future.result()
+                if result['success']:
+                    succeeded += 1
+                if result.get('job_id'):
+                    # url_for richiede il contesto della richiesta, non disponibile nei thread del pool
+                    result['status_url'] = url_for('api_job_status', job_id=result['job_id'])
+                yield json.dumps(result, default=str) + '\n'
+        
+        yield json.dumps({
+            'done': True,
+            'total': len(jobs) + len(errors),
+            'succeeded': succeeded,
+            'failed': len(jobs) + len(errors) - succeeded
+        }) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 @app.route("/dashboard")
 @login_required
 def dashboard():
     user = get_current_user()
-    files = get_uploaded_files(user['folder'])
+    index = get_user_file_index(user['folder'])
+    files = index['files']
     total_files = len(files)
-    total_size = sum(file['size'] for file in files)
-    total_size_mb = round(total_size / (1024 * 1024), 2)
+    total_size_mb = round(index['total_size'] / (1024 * 1024), 2)
     
     storage_info = {
         'mode': 'azure',
         'container': AZURE_CONTAINER_NAME,
         'connected': container_client is not None,
-        'user_folder': user['folder']
+        'user_folder': user['folder'],
+        'index_stats': file_index.stats()
     }
     
     return render_template("dashboard.html", 
@@ -476,27 +816,85 @@ def dashboard():
                          user=user)
 
 
+@app.route("/files/api/list")
+@login_required
+def api_files_list():
+    """API per la lista paginata dei file caricati (?cursor= per la pagina successiva)"""
+    user = get_current_user()
+    page_size = min(int(request.args.get('limit', 100)), 1000)
+    cursor = request.args.get('cursor') or None
+    
+    try:
+        files, next_cursor = list_uploaded_files_page(user['folder'], page_size, cursor)
+    except Exception as e:
+        return jsonify({'error': f'Errore nel recupero dei file: {str(e)}', 'files': []}), 500
+    
+    return jsonify({'files': files, 'next_cursor': next_cursor})
+
+
+@app.route("/files/api/index-stats")
+@login_required
+def api_file_index_stats():
+    """API con i contatori hit/miss dell'indice dei file"""
+    return jsonify(file_index.stats())
+
+
 @app.route("/download/<filename>")
 @login_required
 def download_file(filename):
+    """Download in streaming con supporto a Range (pagine parziali) ed ETag (cache del browser)"""
     try:
         if not container_client:
             flash('Azure Blob Storage non configurato', 'danger')
             return redirect(url_for('dashboard'))
         
         user = get_current_user()
-        file_stream = download_file_from_azure(filename, user['folder'])
-        
-        if file_stream:
-            return send_file(
-                file_stream,
-                as_attachment=True,
-                download_name=filename,
-                mimetype='application/pdf'
-            )
-        else:
+        file_info = get_file_info(filename, user['folder'])
+        
+        if not file_info:
+            flash(f'File "{filename}" non trovato nella tua area', 'danger')
+            return redirect(url_for('dashboard'))
+        
+        etag = file_info['etag']
+        size = file_info['size']
+        headers = {
+            'ETag': etag,
+            'Last-Modified': http_date(file_info['upload_time']),
+            'Accept-Ranges': 'bytes',
+            'Cache-Control': 'private, no-cache',
+            'Content-Disposition': content_disposition(filename)
+        }
+        
+        # La copia in cache del browser è ancora valida: nessun trasferimento
+        if unquote_etag(etag)[0] in request.if_none_match:
+            return Response(status=304, headers=headers)
+        
+        # Richiesta parziale (If-Range: solo se la copia del client è ancora quella attuale).
+        # Più intervalli non sono supportati: come ammesso da RFC 9110 si ignora Range e si invia tutto
+        offset, length, status = None, None, 200
+        if_range = request.headers.get('If-Range')
+        if request.range and len(request.range.ranges) == 1 and (not if_range or if_range == etag):
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                headers['Content-Range'] = f'bytes */{size}'
+                return Response(status=416, headers=headers)
+            start, stop = byte_range
+            offset, length, status = start, stop - start, 206
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        
+        downloader = download_file_from_azure(filename, user['folder'], offset, length, etag)
+        if not downloader:
             flash(f'File "{filename}" non trovato nella tua area', 'danger')
             return redirect(url_for('dashboard'))
+        
+        headers['Content-Length'] = str(length if length is not None else size)
+        return Response(
+            stream_with_context(downloader.chunks()),
+            status=status,
+            mimetype='application/pdf',
+            headers=headers,
+            direct_passthrough=True
+        )
             
     except Exception as e:
         flash(f'Errore durante il download: {str(e)}', 'danger')
@@ -525,8 +923,9 @@ def bills_management():
     """Dashboard per la gestione delle bollette"""
     user = get_current_user()
     
-    # Recupera le bollette dell'utente
-    bills = bill_processor.get_user_bills(user['id'])
+    # Recupera tutte le bollette dell'utente: la pagina le mostra e le raggruppa per tipo
+    # (le query hanno TOP @limit, con il limite predefinito vedrebbe solo le 50 più recenti)
+    bills = bill_processor.get_user_bills(user['id'], limit=None)
     
     # Statistiche
     total_bills = len(bills)
@@ -547,6 +946,16 @@ def bills_management():
         if bill.get('amount'):
             total_amounts_by_type[bill_type] += bill['amount']
     
+    # Totali dagli aggregati materializzati quando disponibili
+    aggregates = bill_processor.get_user_aggregates(user['id'])
+    if aggregates is not None:
+        total_bills = aggregates['total_bills']
+        bills_needing_review = aggregates['bills_needing_review']
+        total_amounts_by_type = {
+            bill_type: type_stats['total_amount']
+            for bill_type, type_stats in aggregates['type_stats'].items()
+        }
+    
     stats = {
         'total_bills': total_bills,
         'bills_needing_review': bills_needing_review,
@@ -562,104 +971,118 @@ def bills_management():
 @app.route("/bills/api/list")
 @login_required
 def api_bills_list():
-    """API per ottenere la lista delle bollette"""
+    """API per ottenere la lista paginata delle bollette"""
     user = get_current_user()
     bill_type = request.args.get('type', 'all')
     
-    if bill_type == 'all':
-        bills = bill_processor.get_user_bills(user['id'])
-    else:
-        bills = bill_processor.get_bills_by_type(user['id'], bill_type)
+    # Proiezione opzionale (?fields=id,amount,...); di default senza il testo estratto
+    fields = BILL_LIST_FIELDS
+    if request.args.get('fields'):
+        fields = [field.strip() for field in request.args['fields'].split(',') if field.strip()]
+        if any(not FIELD_NAME_PATTERN.match(field) for field in fields):
+            return jsonify({'error': 'Campi non validi', 'bills': []}), 400
+    
+    # Paginazione con continuation token di Cosmos (?cursor= per la pagina successiva)
+    page_size = min(int(request.args.get('limit', 50)), 500)
+    cursor = request.args.get('cursor') or None
     
-    return jsonify({'bills': bills})
+    try:
+        bills, next_cursor = bill_processor.get_bills_page(
+            user['id'],
+            None if bill_type == 'all' else bill_type,
+            page_size=page_size,
+            continuation_token=cursor,
+            fields=fields
+        )
+    except Exception as e:
+        return jsonify({'error': f'Errore nel recupero delle bollette: {str(e)}', 'bills': []}), 500
+    
+    return jsonify({'bills': bills, 'next_cursor': next_cursor})
+
+@app.route("/bills/api/bill/<bill_id>")
+@login_required
+def api_bill_detail(bill_id):
+    """API per il dettaglio di una bolletta, testo estratto compreso"""
+    user = get_current_user()
+    bill = bill_processor.get_bill(user['id'], bill_id)
+    
+    if not bill:
+        return jsonify({'error': 'Bolletta non trovata'}), 404
+    
+    return jsonify({'bill': bill})
+
+@app.route("/bills/api/jobs/<job_id>")
+@login_required
+def api_job_status(job_id):
+    """API per lo stato di un job di estrazione"""
+    user = get_current_user()
+    job = job_queue.get_job(job_id)
+    
+    if not job or job['user_id'] != user['id']:
+        return jsonify({'error': 'Job non trovato'}), 404
+    
+    return jsonify({
+        'job_id': job['id'],
+        'status': job['status'],
+        'result': job['result'],
+        'error': job['error'],
+        'attempts': job['attempts'],
+        'last_error': job['last_error'],
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at']
+    })
 
 @app.route("/bills/api/stats")
 @login_required
 def api_bills_stats():
     """API per statistiche delle bollette"""
     user = get_current_user()
-    bills = bill_processor.get_user_bills(user['id'])
-    
-    # Calcola statistiche per grafici usando le date di scadenza
-    monthly_stats = {}
-    type_stats = {}
     
-    for index, bill in enumerate(bills):
-        # Usa la data di scadenza come priorità principale per i grafici
-        bill_date = None
-        
-        # Prima priorità: data di scadenza (due_date)
-        if bill.get('due_date'):
-            try:
-                # due_date è già in formato ISO dalla estrazione
-                bill_date = datetime.fromisoformat(bill['due_date'].replace('Z', '+00:00'))
-            except:
-                pass
-        
-        # Seconda priorità: data estratta
-        if not bill_date and bill.get('extracted_data') and bill['extracted_data'].get('date'):
-            try:
-                date_str = bill['extracted_data']['date']
-                # Prova diversi formati di data
-                for fmt in ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%Y-%m-%d %H:%M:%S']:
-                    try:
-                        bill_date = datetime.strptime(date_str, fmt)
-                        break
-                    except ValueError:
-                        continue
-            except:
-                pass
-        
-        # Fallback: upload_date
-        if not bill_date and bill.get('upload_date'):
-            try:
-                upload_date_str = bill['upload_date']
-                bill_date = datetime.fromisoformat(upload_date_str.replace('Z', '+00:00'))
-            except Exception as e:
-                continue
-        
-        if bill_date:
-            month_key = bill_date.strftime('%Y-%m')
-            
-            if month_key not in monthly_stats:
-                monthly_stats[month_key] = {'count': 0, 'total_amount': 0}
-            
-            monthly_stats[month_key]['count'] += 1
-            if bill.get('amount'):
-                try:
-                    amount = float(str(bill['amount']).replace(',', '.').replace('€', '').strip())
-                    monthly_stats[month_key]['total_amount'] += amount
-                except:
-                    pass
-        
-        # Stats per tipo
-        bill_type = bill.get('bill_type', 'unknown')
-        if bill_type not in type_stats:
-            type_stats[bill_type] = {'count': 0, 'total_amount': 0}
-        
-        type_stats[bill_type]['count'] += 1
-        if bill.get('amount'):
-            try:
-                amount = float(str(bill['amount']).replace(',', '.').replace('€', '').strip())
-                type_stats[bill_type]['total_amount'] += amount
-            except:
-                pass
+    # Aggregati calcolati con query proiettate (date, importo e tipo) invece dei documenti completi
+    stats = bill_processor.get_bill_stats(user['id'])
     
     return jsonify({
-        'monthly_stats': monthly_stats,
-        'type_stats': type_stats
+        'monthly_stats': stats['monthly_stats'],
+        'type_stats': stats['type_stats']
     })
 
+def parse_months_ahead(default=3):
+    """Mesi da prevedere da ?months=, limitati a 1..MAX_MONTHS_AHEAD (ValueError se non è un intero)"""
+    months_ahead = int(request.args.get('months', default))
+    return min(max(months_ahead, 1), MAX_MONTHS_AHEAD)
+
+def parse_float_arg(name):
+    """Parametro numerico opzionale: None se assente, ValueError se non è un numero finito"""
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f'{name} non valido')
+    return number
+
 @app.route("/bills/api/forecast")
 @login_required
 def api_forecast():
     """API per previsioni delle bollette"""
     user = get_current_user()
     bill_type = request.args.get('type')  # Opzionale: filtra per tipo
-    months_ahead = int(request.args.get('months', 3))  # Default 3 mesi
+    model = request.args.get('model') or None  # Opzionale: modello di previsione o 'auto'
+    
+    try:
+        months_ahead = parse_months_ahead()  # Default 3 mesi
+    except ValueError:
+        return jsonify({'error': 'Parametro months non valido', 'predictions': []}), 400
+    
+    if model and model not in model_names():
+        return jsonify({
+            'error': f'Modello di previsione sconosciuto: {model}',
+            'predictions': [],
+            'available_models': model_names()
+        }), 400
     
     try:
-        forecast_data = bill_processor.generate_forecast(user['id'], bill_type, months_ahead)
+        forecast_data = bill_processor.generate_forecast(user['id'], bill_type, months_ahead, model)
         
         # Se c'è un errore (es. nessuna bolletta per quel tipo), ritorna l'errore
         if forecast_data.get('error'):
@@ -678,6 +1101,72 @@ def api_forecast():
             'message': str(e)
         }), 500
 
+@app.route("/bills/api/forecast/consumption")
+@login_required
+def api_consumption_forecast():
+    """API per previsioni dei costi da consumi e prezzo unitario, con scenario di tariffa opzionale"""
+    user = get_current_user()
+    bill_type = request.args.get('type')  # Opzionale: un solo tipo di bolletta
+    model = request.args.get('model') or None
+    
+    try:
+        months_ahead = parse_months_ahead()
+        tariff_change = parse_float_arg('tariff_change')  # Variazione % del prezzo unitario
+        unit_price = parse_float_arg('unit_price')  # Nuovo prezzo in euro per unità
+    except ValueError:
+        return jsonify({'error': 'Parametri non validi', 'predictions': []}), 400
+    
+    if (tariff_change is not None and tariff_change <= -100) or (unit_price is not None and unit_price <= 0):
+        return jsonify({'error': 'Il prezzo unitario dello scenario deve restare positivo', 'predictions': []}), 400
+    
+    if model and model not in model_names():
+        return jsonify({
+            'error': f'Modello di previsione sconosciuto: {model}',
+            'predictions': [],
+            'available_models': model_names()
+        }), 400
+    if unit_price is not None and not bill_type:
+        # Unità diverse per tipo (kWh, Smc, mc): un prezzo unitario vale per un solo tipo
+        return jsonify({'error': 'unit_price richiede il parametro type', 'predictions': []}), 400
+    
+    try:
+        forecast_data = bill_processor.generate_consumption_forecast(
+            user['id'], bill_type, months_ahead, tariff_change, unit_price, model
+        )
+        
+        if forecast_data.get('error'):
+            return jsonify({
+                'error': forecast_data['error'],
+                'predictions': [],
+                'message': 'Carica più bollette con i consumi (kWh, Smc, mc) per questa previsione'
+            }), 400
+        
+        return jsonify(forecast_data)
+        
+    except Exception as e:
+        return jsonify({
+            'error': 'Errore nel calcolo delle previsioni',
+            'predictions': [],
+            'message': str(e)
+        }), 500
+
+@app.route("/bills/api/forecast/models")
+@login_required
+def api_forecast_models():
+    """API con i modelli di previsione selezionabili con ?model="""
+    models = [
+        {'name': model.name, 'label': model.label, 'min_points': model.min_points}
+        for model in MODELS.values()
+    ]
+    models.append({'name': AUTO_MODEL, 'label': 'Scelta automatica (validazione incrociata)', 'min_points': MIN_TRAIN_POINTS})
+    return jsonify({'models': models})
+
+@app.route("/bills/api/forecast/cache-stats")
+@login_required
+def api_forecast_cache_stats():
+    """API con i contatori hit/miss della cache delle previsioni"""
+    return jsonify(bill_processor.forecast_cache.stats())
+
 @app.route("/bills/api/trends")
 @login_required
 def api_consumption_trends():
@@ -0,0 +1,236 @@
+"""Backtest degli algoritmi di previsione con origine mobile.
+
+Per ogni serie mensile e ogni origine t (dal mese --min-train in poi) gli algoritmi vedono
+solo i mesi prima di t e prevedono i successivi --horizon mesi; l'errore è misurato sui valori
+reali. Tutte le finestre di addestramento di un algoritmo sono calcolate in un'unica chiamata
+vettoriale, quindi il tempo per serie misura anche il throughput del motore.
+
+Le serie arrivano da generatori sintetici per tipo di bolletta e da export JSONL di bollette
+(stesso formato di `python -m bill_reprocessor reprocess --input`). Oltre agli algoritmi
+storici si confrontano i modelli del registro (forecast_models), inclusa la scelta 'auto'.
+
+Uso: python benchmarks/backtest_forecast.py [--fixtures benchmarks/fixtures/bills_history.jsonl]
+                                            [--synthetic 200] [--horizon 3] [--min-train 3]
+                                            [--output report.json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bill_aggregates import apply_bill, empty_aggregates, all_monthly_series
+from bill_forecast import SeriesBatch, ADVANCED_MIN_POINTS, linear_predictions, advanced_predictions
+from forecast_models import AUTO_MODEL, forecast_with_model
+
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'bills_history.jsonl')
+
+# Profili stagionali (mese -> fattore) dei generatori sintetici
+SEASONAL_PROFILES = {
+    'gas': lambda month: 1.6 if month in (12, 1, 2) else 0.35 if month in (6, 7, 8) else 0.9,
+    'electricity': lambda month: 1.25 if month in (7, 8) else 1.1 if month in (12, 1, 2) else 0.95,
+    'water': lambda month: 1.05 if month in (6, 7, 8) else 1.0,
+    'telecom': lambda month: 1.0,
+}
+BASE_AMOUNTS = {'gas': 90.0, 'electricity': 70.0, 'water': 35.0, 'telecom': 30.0}
+
+# Lunghezze dello storico per cui confrontare gli algoritmi (le soglie 3/6/12 di generate_forecast)
+TRAIN_BUCKETS = [(3, 5), (6, 11), (12, None)]
+
+
+def synthetic_series(bill_type, length, rng, start_year=2021):
+    """Serie mensile con stagionalità del tipo, trend lieve e rumore moltiplicativo"""
+    trend = rng.uniform(-0.005, 0.01)
+    noise = rng.uniform(0.03, 0.12)
+    series = []
+    for i in range(length):
+        month = i % 12 + 1
+        amount = BASE_AMOUNTS[bill_type] * SEASONAL_PROFILES[bill_type](month) * (1 + trend * i)
+        amount *= 1 + rng.normal(0, noise)
+        series.append((f"{start_year + i // 12}-{month:02d}", max(float(amount), 1.0)))
+    return series
+
+
+def load_synthetic(count, rng):
+    series = {}
+    bill_types = list(SEASONAL_PROFILES)
+    for i in range(count):
+        bill_type = bill_types[i % len(bill_types)]
+        series[('synthetic', f"s{i}", bill_type)] = synthetic_series(bill_type, int(rng.integers(8, 37)), rng)
+    return series
+
+
+def load_fixtures(path):
+    """Serie mensili per utente e tipo da un export JSONL di bollette"""
+    aggregates_by_user = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            bill = json.loads(line)
+            aggregates = aggregates_by_user.get(bill['user_id'])
+            if aggregates is None:
+                aggregates = aggregates_by_user[bill['user_id']] = empty_aggregates(bill['user_id'])
+            apply_bill(aggregates, bill)
+
+    series = {}
+    for user_id, aggregates in aggregates_by_user.items():
+        for bill_type, monthly in all_monthly_series(aggregates).items():
+            if bill_type is not None:
+                series[('fixture', user_id, bill_type)] = monthly
+    return series
+
+
+def rolling_windows(series_by_key, horizon, min_train):
+    """Finestre (chiave, storico, valori reali) per ogni origine possibile"""
+    windows = []
+    for key, series in series_by_key.items():
+        for origin in range(min_train, len(series) - horizon + 1):
+            actual = np.array([amount for _, amount in series[origin:origin + horizon]])
+            windows.append((key, series[:origin], actual))
+    return windows
+
+
+def _predict_naive(histories, horizon, bill_types):
+    """Riferimento: l'ultimo mese si ripete"""
+    last = np.array([history[-1][1] for history in histories])
+    return np.tile(last, (horizon, 1))
+
+
+def _predict_model(name):
+    """Modello del registro; le finestre troppo corte per il modello usano la scelta predefinita"""
+    def predict(histories, horizon, bill_types):
+        series_by_key = dict(enumerate(histories))
+        forecasts = forecast_with_model(series_by_key, horizon, name, dict(enumerate(bill_types)))
+        return np.array([[p['predicted_amount'] for p in forecasts[i]['predictions']]
+                         for i in range(len(histories))]).T
+    return predict
+
+
+def _predict_linear(histories, horizon, bill_types):
+    # Come generate_forecast: l'algoritmo lineare non usa i fattori per tipo
+    return linear_predictions(SeriesBatch(histories), horizon)
+
+
+def _predict_advanced(histories, horizon, bill_types):
+    return advanced_predictions(SeriesBatch(histories), horizon, bill_types)
+
+
+ALGORITHMS = {
+    'naive': _predict_naive,
+    'linear': _predict_linear,
+    'advanced': _predict_advanced,
+    'seasonal_naive': _predict_model('seasonal_naive'),
+    'holt_winters': _predict_model('holt_winters'),
+    'auto': _predict_model(AUTO_MODEL),
+}
+
+
+def run_algorithm(predict, windows, horizon):
+    """Previsioni di tutte le finestre in un'unica chiamata: (matrice finestre x orizzonti, secondi)"""
+    start = time.perf_counter()
+    predicted = predict([history for _, history, _ in windows], horizon, [key[2] for key, _, _ in windows])
+    elapsed = time.perf_counter() - start
+    return predicted.T, elapsed
+
+
+def error_metrics(predicted, actual):
+    errors = np.abs(predicted - actual)
+    return {
+        'mae': float(errors.mean()),
+        'mape': float((errors / actual).mean() * 100),
+        'windows': int(len(actual))
+    }
+
+
+def backtest(series_by_key, horizon=3, min_train=3, algorithms=ALGORITHMS):
+    windows = rolling_windows(series_by_key, horizon, min_train)
+    if not windows:
+        raise ValueError('Nessuna finestra: serie troppo corte per orizzonte e storico minimo')
+
+    actual = np.array([window[2] for window in windows])
+    bill_types = np.array([key[2] for key, _, _ in windows])
+    train_lengths = np.array([len(history) for _, history, _ in windows])
+
+    report = {'windows': len(windows), 'series': len(series_by_key), 'horizon': horizon, 'algorithms': {}}
+    predictions = {}
+    for name, predict in algorithms.items():
+        predicted, elapsed = run_algorithm(predict, windows, horizon)
+        predictions[name] = predicted
+        result = error_metrics(predicted, actual)
+        result['ms_per_series'] = elapsed / len(windows) * 1000
+        result['series_per_second'] = len(windows) / elapsed if elapsed else float('inf')
+        result['by_type'] = {
+            bill_type: error_metrics(predicted[bill_types == bill_type], actual[bill_types == bill_type])
+            for bill_type in sorted(set(bill_types))
+        }
+        result['by_train_length'] = {}
+        for low, high in TRAIN_BUCKETS:
+            selected = (train_lengths >= low) & (train_lengths <= (high or train_lengths.max()))
+            if selected.any():
+                label = f"{low}-{high}" if high else f"{low}+"
+                result['by_train_length'][label] = error_metrics(predicted[selected], actual[selected])
+        report['algorithms'][name] = result
+
+    # Scelta attuale di generate_forecast: avanzato da 6 mesi di storico, lineare prima
+    if 'linear' in predictions and 'advanced' in predictions:
+        use_advanced = (train_lengths >= ADVANCED_MIN_POINTS)[:, None]
+        report['algorithms']['current_cutover'] = error_metrics(
+            np.where(use_advanced, predictions['advanced'], predictions['linear']), actual
+        )
+    return report
+
+
+def print_report(title, report):
+    print(f"\n{title}: {report['series']} serie, {report['windows']} finestre, orizzonte {report['horizon']} mesi")
+    print(f"{'algoritmo':<16}{'MAPE %':>9}{'MAE €':>9}{'ms/serie':>10}{'serie/s':>11}")
+    for name, result in report['algorithms'].items():
+        timing = (f"{result['ms_per_series']:>10.4f}{result['series_per_second']:>11.0f}"
+                  if 'ms_per_series' in result else '')
+        print(f"{name:<16}{result['mape']:>9.2f}{result['mae']:>9.2f}{timing}")
+
+    for group in ('by_type', 'by_train_length'):
+        labels = sorted({label for result in report['algorithms'].values() for label in result.get(group, {})})
+        print(f"\nMAPE % {'per tipo' if group == 'by_type' else 'per mesi di storico'}")
+        print(f"{'':<16}" + ''.join(f"{label:>13}" for label in labels))
+        for name, result in report['algorithms'].items():
+            if group not in result:
+                continue
+            cells = ''.join(
+                f"{result[group][label]['mape']:>13.2f}" if label in result[group] else f"{'-':>13}"
+                for label in labels
+            )
+            print(f"{name:<16}{cells}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixtures', default=DEFAULT_FIXTURES, help='Export JSONL di bollette')
+    parser.add_argument('--synthetic', type=int, default=200, help='Numero di serie sintetiche')
+    parser.add_argument('--horizon', type=int, default=3)
+    parser.add_argument('--min-train', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=11)
+    parser.add_argument('--output', help='Salva il report completo in JSON')
+    args = parser.parse_args()
+
+    sources = {}
+    if args.synthetic:
+        sources['Sintetiche'] = load_synthetic(args.synthetic, np.random.default_rng(args.seed))
+    if args.fixtures and os.path.exists(args.fixtures):
+        sources['Fixture JSONL'] = load_fixtures(args.fixtures)
+
+    reports = {}
+    for title, series_by_key in sources.items():
+        reports[title] = backtest(series_by_key, args.horizon, args.min_train)
+        print_report(title, reports[title])
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
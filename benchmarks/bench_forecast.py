@@ -0,0 +1,62 @@
+"""Micro-benchmark degli intervalli di previsione: bootstrap vettoriale dei residui
+al variare della lunghezza dello storico, dell'orizzonte e del numero di serie.
+
+Uso: python benchmarks/bench_forecast.py [--repeat 200] [--samples 400]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bill_forecast import SeriesBatch, fit_trend, prediction_intervals, forecast_series
+
+
+def synthetic_series(length, rng, start_year=2020):
+    """Serie mensile con trend, stagionalità annuale e rumore"""
+    months = np.arange(length)
+    amounts = 80 + 0.8 * months + 20 * np.sin(2 * np.pi * months / 12) + rng.normal(0, 8, length)
+    return [(f"{start_year + m // 12}-{m % 12 + 1:02d}", float(max(a, 1.0))) for m, a in zip(months, amounts)]
+
+
+def bench_intervals(length, months_ahead, columns, samples, repeat, rng):
+    batch = SeriesBatch([synthetic_series(length, rng) for _ in range(columns)])
+    slope, intercept = fit_trend(batch)
+    predicted = np.full((months_ahead, columns), 100.0)
+
+    # Stessi dati, stessi intervalli: la risposta si può memorizzare
+    first = prediction_intervals(batch, slope, intercept, predicted, 0.15, samples=samples)
+    second = prediction_intervals(batch, slope, intercept, predicted, 0.15, samples=samples)
+    assert all(np.array_equal(a, b) for a, b in zip(first, second)), 'Intervalli non deterministici!'
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        prediction_intervals(batch, slope, intercept, predicted, 0.15, samples=samples)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--samples', type=int, default=400)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(7)
+    for columns in (1, 5):
+        for length in (6, 12, 24, 60):
+            for months_ahead in (3, 12):
+                elapsed_ms = bench_intervals(length, months_ahead, columns, args.samples, args.repeat, rng)
+                print(f"{columns} serie x {length:>2} mesi, orizzonte {months_ahead:>2}: "
+                      f"bootstrap {elapsed_ms:6.3f} ms  ({elapsed_ms / columns:6.3f} ms per serie)")
+
+    # Intervallo di una serie indipendente dalle altre serie del batch
+    series = {'gas': synthetic_series(24, rng), 'electricity': synthetic_series(18, rng)}
+    together = forecast_series(series, 3)
+    alone = forecast_series({'gas': series['gas']}, 3)
+    assert together['gas']['predictions'] == alone['gas']['predictions'], 'Intervalli dipendenti dal batch!'
+
+
+if __name__ == '__main__':
+    main()
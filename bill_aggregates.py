@@ -0,0 +1,197 @@
+import math
+from datetime import datetime
+from bill_stats import parse_amount, resolve_bill_date
+from field_extractor import CONSUMPTION_PATTERNS
+
+# Campi delle bollette necessari per ricostruire gli aggregati di un utente
+AGGREGATES_SOURCE_QUERY = (
+    "SELECT c.due_date, c.amount, c.bill_type, c.upload_date, c.extracted_data.date AS extracted_date, "
+    "c.consumption, c.manual_review_needed FROM c WHERE c.user_id = @user_id"
+)
+
+
+# Versione dello schema: gli aggregati salvati con uno schema precedente si ricostruiscono alla lettura
+AGGREGATES_SCHEMA = 2
+
+# Unità di consumo attesa per tipo di bolletta (campi di FieldExtractor.extract_consumption)
+UNIT_FIELDS = {
+    'electricity': 'electricity_kwh',
+    'gas': 'gas_smc',
+    'water': 'water_mc'
+}
+
+
+def aggregates_id(user_id):
+    return f"aggregates_{user_id}"
+
+
+def empty_aggregates(user_id):
+    """Documento aggregato vuoto di un utente"""
+    return {
+        'id': aggregates_id(user_id),
+        'user_id': user_id,
+        'total_bills': 0,
+        'bills_needing_review': 0,
+        'monthly': {},
+        'type_stats': {},
+        'usage': {},
+        'schema': AGGREGATES_SCHEMA,
+        'version': 0,
+        'updated_at': datetime.now().isoformat()
+    }
+
+
+def consumption_quantities(consumption):
+    """Consumi tipizzati {campo unità: quantità} di una bolletta.
+
+    Le bollette estratte hanno già un dizionario numerico; quelle salvate con un
+    parser precedente (consumo come testo, es. "350 kWh") si leggono con gli stessi pattern.
+    """
+    if isinstance(consumption, dict):
+        return {
+            field: float(value) for field, value in consumption.items()
+            if isinstance(value, (int, float)) and value > 0
+        }
+    quantities = {}
+    text = str(consumption or '')
+    for field, keyword, pattern in CONSUMPTION_PATTERNS:
+        if keyword not in text.lower():
+            continue
+        matches = pattern.findall(text)
+        if matches:
+            try:
+                value = float(matches[-1].replace(',', '.'))
+            except ValueError:
+                continue
+            if value > 0:
+                quantities[field] = value
+    return quantities
+
+
+def bill_usage(bill):
+    """(campo unità, quantità) del consumo di una bolletta: l'unità del suo tipo, se presente"""
+    quantities = consumption_quantities(bill.get('consumption'))
+    unit = UNIT_FIELDS.get(bill.get('bill_type'))
+    if unit in quantities:
+        return unit, quantities[unit]
+    if len(quantities) == 1:
+        return next(iter(quantities.items()))
+    return None, 0.0
+
+
+def apply_bill(aggregates, bill):
+    """Aggiunge una bolletta agli aggregati (aggiornamento incrementale, O(1))"""
+    bill_type = bill.get('bill_type') or 'unknown'
+    amount = parse_amount(bill.get('amount'))
+    amount = 0.0 if math.isnan(amount) else amount
+
+    aggregates['total_bills'] += 1
+    if bill.get('manual_review_needed'):
+        aggregates['bills_needing_review'] += 1
+
+    type_stats = aggregates['type_stats'].setdefault(bill_type, {'count': 0, 'total_amount': 0.0})
+    type_stats['count'] += 1
+    type_stats['total_amount'] += amount
+
+    bill_date = resolve_bill_date(bill)
+    if bill_date:
+        month = aggregates['monthly'].setdefault(
+            bill_date.strftime('%Y-%m'), {'count': 0, 'total_amount': 0.0, 'by_type': {}}
+        )
+        month['count'] += 1
+        month['total_amount'] += amount
+        month_type = month['by_type'].setdefault(bill_type, {'count': 0, 'total_amount': 0.0})
+        month_type['count'] += 1
+        month_type['total_amount'] += amount
+
+    # Serie numeriche dei consumi per tipo e unità, sugli stessi mesi degli importi:
+    # l'importo delle sole bollette con consumo dà il prezzo unitario del mese
+    unit, quantity = bill_usage(bill)
+    if quantity > 0 and bill_date:
+        unit_months = aggregates.setdefault('usage', {}).setdefault(bill_type, {}).setdefault(unit, {})
+        month_usage = unit_months.setdefault(bill_date.strftime('%Y-%m'), {'quantity': 0.0, 'amount': 0.0, 'count': 0})
+        month_usage['quantity'] += quantity
+        month_usage['amount'] += amount
+        month_usage['count'] += 1
+
+    aggregates['version'] += 1
+    aggregates['updated_at'] = datetime.now().isoformat()
+    return aggregates
+
+
+def build_aggregates(user_id, bills):
+    """Ricostruisce da zero gli aggregati di un utente"""
+    aggregates = empty_aggregates(user_id)
+    for bill in bills:
+        apply_bill(aggregates, bill)
+    return aggregates
+
+
+def count_bills(aggregates, bill_type=None):
+    if bill_type:
+        return aggregates['type_stats'].get(bill_type, {}).get('count', 0)
+    return aggregates['total_bills']
+
+
+def monthly_stats(aggregates):
+    """Statistiche mensili {mese: {'count', 'total_amount'}} come /bills/api/stats"""
+    return {
+        month: {'count': data['count'], 'total_amount': data['total_amount']}
+        for month, data in sorted(aggregates['monthly'].items())
+    }
+
+
+def monthly_series(aggregates, bill_type=None):
+    """Serie [(mese, totale)] ordinata per mese, solo mesi con importo positivo"""
+    series = []
+    for month, data in sorted(aggregates['monthly'].items()):
+        if bill_type:
+            total = data['by_type'].get(bill_type, {}).get('total_amount', 0)
+        else:
+            total = data['total_amount']
+        if total > 0:
+            series.append((month, total))
+    return series
+
+
+def all_monthly_series(aggregates):
+    """Serie mensili di ogni tipo di bolletta e del totale (chiave None)"""
+    series = {bill_type: monthly_series(aggregates, bill_type) for bill_type in aggregates['type_stats']}
+    series[None] = monthly_series(aggregates)
+    return series
+
+
+def usage_unit(aggregates, bill_type):
+    """Unità dei consumi di un tipo di bolletta: quella attesa se presente, altrimenti la più frequente"""
+    units = aggregates.get('usage', {}).get(bill_type, {})
+    if not units:
+        return None
+    if UNIT_FIELDS.get(bill_type) in units:
+        return UNIT_FIELDS[bill_type]
+    return max(units, key=lambda unit: len(units[unit]))
+
+
+def usage_series(aggregates, bill_type):
+    """Serie [(mese, quantità, importo)] dei consumi di un tipo di bolletta, ordinata per mese"""
+    unit = usage_unit(aggregates, bill_type)
+    if unit is None:
+        return []
+    months = aggregates['usage'][bill_type][unit]
+    return [
+        (month, data['quantity'], data['amount'])
+        for month, data in sorted(months.items())
+        if data['quantity'] > 0
+    ]
+
+
+def all_usage_series(aggregates):
+    """Unità e serie dei consumi di ogni tipo di bolletta: {tipo: (unità, serie)}"""
+    return {
+        bill_type: (usage_unit(aggregates, bill_type), usage_series(aggregates, bill_type))
+        for bill_type in aggregates.get('usage', {})
+    }
+
+
+def consumption_series(aggregates, bill_type):
+    """Consumi {mese: quantità} di un tipo di bolletta"""
+    return {month: quantity for month, quantity, _ in usage_series(aggregates, bill_type)}
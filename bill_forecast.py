@@ -0,0 +1,409 @@
+"""Previsioni vettoriali su più serie mensili (es. tutti i tipi di bolletta di un utente).
+
+Le serie [(mese, totale)] vengono allineate a destra in una matrice mesi x serie
+(NaN dove una serie è più corta): trend lineare, EMA e stagionalità si calcolano
+per tutte le colonne insieme, con le stesse formule degli algoritmi per singola serie.
+Differenza voluta: i mesi da prevedere sono mesi di calendario, mentre l'algoritmo
+avanzato per singola serie avanzava di 30 giorni e poteva ripetere un mese
+(2024-01 -> 2024-01); mesi previsti e fattori stagionali applicati possono quindi differire.
+"""
+import numpy as np
+from datetime import datetime
+
+ADVANCED_MIN_POINTS = 6
+# Orizzonte massimo richiedibile: il bootstrap degli intervalli alloca campioni x mesi x serie
+MAX_MONTHS_AHEAD = 24
+SEASONAL_MIN_POINTS = 12
+EMA_ALPHA = 0.3
+
+# Intervalli di previsione: bootstrap dei residui con seme fisso (stessi dati, stessa risposta)
+INTERVAL_LEVEL = 0.8
+BOOTSTRAP_SAMPLES = 400
+BOOTSTRAP_SEED = 20240601
+
+# Fattori stagionali dell'algoritmo avanzato per tipo di bolletta (inverno, estate, resto dell'anno)
+BILL_TYPE_FACTORS = {
+    'electricity': {'winter': 1.1, 'summer': 1.15, 'other': 1.0},
+    'gas': {'winter': 1.2, 'summer': 0.8, 'other': 1.0},
+    'water': {'winter': 0.95, 'summer': 1.05, 'other': 1.0},
+    'telecom': {'winter': 1.0, 'summer': 1.0, 'other': 1.0}
+}
+
+WINTER_MONTHS = [12, 1, 2]
+
+
+class SeriesBatch:
+    """Serie mensili allineate a destra: l'ultima riga è l'ultimo mese di ogni serie"""
+
+    def __init__(self, series_list):
+        self.lengths = np.array([len(series) for series in series_list])
+        rows = int(self.lengths.max()) if len(series_list) else 0
+        columns = len(series_list)
+
+        self.amounts = np.full((rows, columns), np.nan)
+        self.calendar_months = np.zeros((rows, columns), dtype=int)
+        self.last_months = []
+
+        for column, series in enumerate(series_list):
+            offset = rows - len(series)
+            for row, (month_str, amount) in enumerate(series, start=offset):
+                self.amounts[row, column] = amount
+                self.calendar_months[row, column] = int(month_str[5:7])
+            self.last_months.append((int(series[-1][0][:4]), int(series[-1][0][5:7])))
+
+        self.mask = ~np.isnan(self.amounts)
+        # Posizione di ogni punto nella propria serie (0 = primo mese della serie)
+        self.positions = np.arange(rows)[:, None] - (rows - self.lengths)[None, :]
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+def fit_trend(batch):
+    """Regressione lineare per colonna (come np.polyfit di grado 1): (pendenza, intercetta)"""
+    n = batch.lengths.astype(float)
+    x = np.where(batch.mask, batch.positions, 0).astype(float)
+    y = np.where(batch.mask, batch.amounts, 0.0)
+
+    sum_x = x.sum(axis=0)
+    sum_y = y.sum(axis=0)
+    sum_xx = (x * x).sum(axis=0)
+    sum_xy = (x * y).sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (n * sum_xy - sum_x * sum_y) / (n * sum_xx - sum_x ** 2)
+    slope = np.nan_to_num(slope)
+    intercept = (sum_y - slope * sum_x) / n
+    return slope, intercept
+
+
+def series_means(batch):
+    return np.where(batch.mask, batch.amounts, 0.0).sum(axis=0) / batch.lengths
+
+
+def last_ema(batch, alpha=EMA_ALPHA):
+    """Ultimo valore della media mobile esponenziale di ogni colonna, in forma chiusa.
+
+    ema_n = (1-a)^(n-1) * y_0 + somma_j a * (1-a)^(n-1-j) * y_j: con le serie allineate a destra
+    il peso dipende solo dalla riga, tranne il primo punto che riceve (1-a)^(n-1) invece di a*(1-a)^(n-1).
+    """
+    rows = batch.amounts.shape[0]
+    weights = alpha * (1 - alpha) ** np.arange(rows - 1, -1, -1)
+    ema = weights @ np.where(batch.mask, batch.amounts, 0.0)
+
+    first_values = batch.amounts[rows - batch.lengths, np.arange(len(batch))]
+    return ema + (1 - alpha) ** batch.lengths * first_values
+
+
+def seasonal_means(batch):
+    """Media per mese di calendario (righe 1-12) di ogni colonna, NaN se il mese non compare"""
+    columns = np.broadcast_to(np.arange(len(batch)), batch.amounts.shape)
+    sums = np.zeros((13, len(batch)))
+    counts = np.zeros((13, len(batch)))
+    np.add.at(sums, (batch.calendar_months[batch.mask], columns[batch.mask]), batch.amounts[batch.mask])
+    np.add.at(counts, (batch.calendar_months[batch.mask], columns[batch.mask]), 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums / counts
+
+
+def trend_residuals(batch, slope, intercept):
+    """Residui del trend lineare (NaN fuori dalle serie)"""
+    fitted = slope * batch.positions + intercept
+    return np.where(batch.mask, batch.amounts - fitted, np.nan)
+
+
+def prediction_intervals(batch, slope, intercept, predicted, fallback_margin,
+                         level=INTERVAL_LEVEL, samples=BOOTSTRAP_SAMPLES, seed=BOOTSTRAP_SEED):
+    """Intervalli (min, max) dai residui del trend, con bootstrap vettoriale su orizzonti e serie.
+
+    Gli errori relativi (residuo / media) ricampionati vengono allargati con il fattore della
+    regressione fuori campione sqrt(1 + 1/n + (x - media_x)^2 / Sxx). Le estrazioni uniformi
+    sono le stesse per tutte le serie e per ogni orizzonte, quindi l'intervallo di una serie
+    non dipende da quali altre serie sono nel batch né da quanti mesi si prevedono.
+    """
+    rows = batch.amounts.shape[0]
+    n = batch.lengths
+    months_ahead = predicted.shape[0]
+    horizons = np.arange(1, months_ahead + 1)[:, None]
+
+    # Errori relativi, corretti per i due parametri stimati dal trend
+    scale = np.sqrt(n / np.maximum(n - 2, 1))
+    relative = trend_residuals(batch, slope, intercept) / series_means(batch) * scale
+
+    x_mean = (n - 1) / 2
+    sum_xx = n * (n ** 2 - 1) / 12
+    spread = np.sqrt(1 + 1 / n + (n + horizons - 1 - x_mean) ** 2 / np.maximum(sum_xx, 1e-9))
+
+    uniform = np.random.default_rng(seed).random((months_ahead, samples)).T
+    sample_rows = rows - n + np.floor(uniform[:, :, None] * n).astype(int)
+    draws = relative[sample_rows, np.arange(len(batch))] * spread
+
+    lower_q, upper_q = np.quantile(draws, [(1 - level) / 2, (1 + level) / 2], axis=0)
+    lower = np.maximum(predicted * (1 + lower_q), 0)
+    upper = np.maximum(predicted * (1 + upper_q), lower)
+
+    # Con meno di 3 punti il trend passa per tutti i dati: nessun residuo, margine fisso
+    short = n < 3
+    lower = np.where(short, predicted * (1 - fallback_margin), lower)
+    upper = np.where(short, predicted * (1 + fallback_margin), upper)
+    return lower, upper
+
+
+def future_months(batch, months_ahead):
+    """Anni e mesi (matrici orizzonti x colonne) dei mesi da prevedere"""
+    last = np.array(batch.last_months).reshape(-1, 2)
+    month_index = last[:, 0] * 12 + (last[:, 1] - 1) + np.arange(1, months_ahead + 1)[:, None]
+    return month_index // 12, month_index % 12 + 1
+
+
+def _month_label(year, month):
+    month_date = datetime(int(year), int(month), 1)
+    return month_date.strftime('%Y-%m'), month_date.strftime('%B %Y')
+
+
+def _trend_label(slope):
+    return 'crescente' if slope > 0 else 'decrescente' if slope < 0 else 'stabile'
+
+
+def _linear_seasonal_factors(months, bill_types):
+    """Fattori stagionali dell'algoritmo lineare (orizzonti x colonne)"""
+    factors = 1 + 0.05 * np.sin(2 * np.pi * months / 12)
+    for column, bill_type in enumerate(bill_types):
+        column_months = months[:, column]
+        if bill_type == 'gas':
+            # Gas molto più basso in estate, più alto in inverno
+            factors[:, column] = np.select(
+                [np.isin(column_months, [7, 8]), np.isin(column_months, WINTER_MONTHS)], [0.4, 1.3], 0.8
+            )
+        elif bill_type == 'electricity':
+            # Elettricità più alta in estate (climatizzazione) e leggermente in inverno
+            factors[:, column] = np.select(
+                [np.isin(column_months, [7, 8]), np.isin(column_months, WINTER_MONTHS)], [1.2, 1.1], 1.0
+            )
+    return factors
+
+
+def _type_factors(months, bill_types):
+    """Fattori per tipo di bolletta dell'algoritmo avanzato (orizzonti x colonne)"""
+    factors = np.ones(months.shape)
+    for column, bill_type in enumerate(bill_types):
+        if bill_type not in BILL_TYPE_FACTORS:
+            continue
+        type_factors = BILL_TYPE_FACTORS[bill_type]
+        column_months = months[:, column]
+        factors[:, column] = np.select(
+            [np.isin(column_months, WINTER_MONTHS), np.isin(column_months, [6, 7, 8])],
+            [type_factors['winter'], type_factors['summer']],
+            type_factors['other']
+        )
+    return factors
+
+
+def _linear_components(batch, months_ahead, bill_types):
+    bill_types = bill_types or [None] * len(batch)
+    raw_slope, intercept = fit_trend(batch)
+    averages = series_means(batch)
+
+    # Limita la pendenza per evitare crescite eccessive (massimo 5% della media per mese)
+    max_slope = averages * 0.05
+    slope = np.clip(raw_slope, -max_slope, max_slope)
+
+    horizons = np.arange(1, months_ahead + 1)[:, None]
+    years, months = future_months(batch, months_ahead)
+
+    predicted = slope * (batch.lengths + horizons - 1) + intercept
+    predicted *= _linear_seasonal_factors(months, bill_types)
+
+    # Normalizzazione verso la media storica con peso crescente per i mesi lontani
+    weight_to_avg = np.minimum(horizons * 0.1, 0.3)
+    predicted = np.maximum(predicted * (1 - weight_to_avg) + averages * weight_to_avg, 0)
+    return raw_slope, slope, intercept, averages, years, months, predicted
+
+
+def linear_predictions(batch, months_ahead, bill_types=None):
+    """Solo gli importi previsti dall'algoritmo lineare (orizzonti x colonne)"""
+    return _linear_components(batch, months_ahead, bill_types)[-1]
+
+
+def linear_forecasts(batch, months_ahead, bill_types=None):
+    """Regressione lineare con pendenza limitata e ritorno verso la media, per tutte le colonne"""
+    raw_slope, slope, intercept, averages, years, months, predicted = _linear_components(
+        batch, months_ahead, bill_types
+    )
+    lower, upper = prediction_intervals(batch, raw_slope, intercept, predicted, fallback_margin=0.15)
+
+    forecasts = []
+    for column in range(len(batch)):
+        values = batch.amounts[batch.mask[:, column], column]
+        forecast = {
+            'predictions': [],
+            'trend': _trend_label(slope[column]),
+            'confidence': 'media',
+            'historical_average': float(averages[column]),
+            'last_month_amount': float(values[-1]),
+            'interval_level': INTERVAL_LEVEL,
+            'debug_info': {
+                'original_slope': float(raw_slope[column]),
+                'capped_slope': float(slope[column]),
+                'data_points': int(batch.lengths[column]),
+                'amounts_range': f"{float(values.min()):.2f} - {float(values.max()):.2f}"
+            }
+        }
+        for h in range(months_ahead):
+            amount = float(predicted[h, column])
+            month, month_name = _month_label(years[h, column], months[h, column])
+            forecast['predictions'].append({
+                'month': month,
+                'month_name': month_name,
+                'predicted_amount': round(amount, 2),
+                'confidence_interval': {
+                    'min': round(float(lower[h, column]), 2),
+                    'max': round(float(upper[h, column]), 2)
+                }
+            })
+        forecasts.append(forecast)
+    return forecasts
+
+
+def _advanced_components(batch, months_ahead, bill_types):
+    bill_types = bill_types or [None] * len(batch)
+    slope, intercept = fit_trend(batch)
+    averages = series_means(batch)
+    ema = last_ema(batch)
+
+    horizons = np.arange(1, months_ahead + 1)[:, None]
+    years, months = future_months(batch, months_ahead)
+    columns = np.arange(len(batch))
+
+    linear_pred = slope * (batch.lengths + horizons - 1) + intercept
+    ema_pred = np.broadcast_to(ema * (1 + slope / averages * 0.05), linear_pred.shape)
+    base_prediction = 0.7 * linear_pred + 0.3 * ema_pred
+
+    # Stagionalità osservata con almeno 12 mesi di storico, altrimenti generica
+    observed = seasonal_means(batch)[months, columns] / averages
+    generic = 1 + 0.08 * np.sin(2 * np.pi * months / 12)
+    use_observed = (batch.lengths >= SEASONAL_MIN_POINTS) & ~np.isnan(observed)
+    seasonal_factor = np.where(use_observed, observed, generic)
+
+    type_factor = _type_factors(months, bill_types)
+
+    # Damping per evitare crescite eccessive nei mesi futuri
+    damping_factor = 1 / (1 + horizons * 0.02)
+    predicted = np.maximum(base_prediction * seasonal_factor * type_factor * damping_factor, 0)
+    return (slope, intercept, averages, years, months,
+            linear_pred, ema_pred, seasonal_factor, type_factor, predicted)
+
+
+def advanced_predictions(batch, months_ahead, bill_types=None):
+    """Solo gli importi previsti dall'algoritmo avanzato (orizzonti x colonne)"""
+    return _advanced_components(batch, months_ahead, bill_types)[-1]
+
+
+def advanced_forecasts(batch, months_ahead, bill_types=None):
+    """Trend lineare + EMA + stagionalità + fattori per tipo, per tutte le colonne"""
+    (slope, intercept, averages, years, months,
+     linear_pred, ema_pred, seasonal_factor, type_factor, predicted) = _advanced_components(
+        batch, months_ahead, bill_types
+    )
+    lower, upper = prediction_intervals(batch, slope, intercept, predicted, fallback_margin=0.12)
+
+    forecasts = []
+    for column in range(len(batch)):
+        values = batch.amounts[batch.mask[:, column], column]
+        forecast = {
+            'predictions': [],
+            'trend': _trend_label(slope[column]),
+            'confidence': 'alta',
+            'historical_average': float(averages[column]),
+            'last_month_amount': float(values[-1]),
+            'interval_level': INTERVAL_LEVEL,
+            'algorithm': 'Advanced Local (Linear + EMA + Seasonal)'
+        }
+        for h in range(months_ahead):
+            amount = float(predicted[h, column])
+            month, month_name = _month_label(years[h, column], months[h, column])
+            forecast['predictions'].append({
+                'month': month,
+                'month_name': month_name,
+                'predicted_amount': round(amount, 2),
+                'confidence_interval': {
+                    'min': round(float(lower[h, column]), 2),
+                    'max': round(float(upper[h, column]), 2)
+                },
+                'algorithm_details': {
+                    'linear_component': round(float(linear_pred[h, column]), 2),
+                    'ema_component': round(float(ema_pred[h, column]), 2),
+                    'seasonal_factor': round(float(seasonal_factor[h, column]), 3),
+                    'type_factor': round(float(type_factor[h, column]), 3)
+                }
+            })
+        forecasts.append(forecast)
+    return forecasts
+
+
+def build_forecasts(batch, predicted, algorithm, confidence):
+    """Previsioni nel formato delle API dagli importi previsti, con gli intervalli dai residui del trend"""
+    months_ahead = predicted.shape[0]
+    slope, intercept = fit_trend(batch)
+    averages = series_means(batch)
+    years, months = future_months(batch, months_ahead)
+    lower, upper = prediction_intervals(batch, slope, intercept, predicted, fallback_margin=0.12)
+
+    forecasts = []
+    for column in range(len(batch)):
+        values = batch.amounts[batch.mask[:, column], column]
+        forecast = {
+            'predictions': [],
+            'trend': _trend_label(slope[column]),
+            'confidence': confidence,
+            'historical_average': float(averages[column]),
+            'last_month_amount': float(values[-1]),
+            'interval_level': INTERVAL_LEVEL,
+            'algorithm': algorithm
+        }
+        for h in range(months_ahead):
+            month, month_name = _month_label(years[h, column], months[h, column])
+            forecast['predictions'].append({
+                'month': month,
+                'month_name': month_name,
+                'predicted_amount': round(float(predicted[h, column]), 2),
+                'confidence_interval': {
+                    'min': round(float(lower[h, column]), 2),
+                    'max': round(float(upper[h, column]), 2)
+                }
+            })
+        forecasts.append(forecast)
+    return forecasts
+
+
+def forecasts_id(user_id):
+    """Id del documento con le previsioni precalcolate di un utente (container degli aggregati)"""
+    return f"forecasts_{user_id}"
+
+
+def truncate_forecast(forecast, months_ahead):
+    """Previsione ridotta ai primi months_ahead mesi (gli orizzonti non dipendono dal totale)"""
+    return {**forecast, 'predictions': forecast['predictions'][:months_ahead]}
+
+
+def forecast_series(series_by_key, months_ahead, bill_types=None):
+    """Previsioni per più serie in un'unica passata: {chiave: previsione}.
+
+    Le serie con almeno 6 mesi usano l'algoritmo avanzato, le altre quello lineare
+    (senza fattori per tipo, come per la singola serie). bill_types associa a ogni
+    chiave il tipo di bolletta (default: la chiave stessa).
+    """
+    bill_types = bill_types or {}
+    advanced_keys = [key for key, series in series_by_key.items() if len(series) >= ADVANCED_MIN_POINTS]
+    linear_keys = [key for key, series in series_by_key.items()
+                   if 2 <= len(series) < ADVANCED_MIN_POINTS]
+
+    forecasts = {}
+    if advanced_keys:
+        batch = SeriesBatch([series_by_key[key] for key in advanced_keys])
+        types = [bill_types.get(key, key) for key in advanced_keys]
+        forecasts.update(zip(advanced_keys, advanced_forecasts(batch, months_ahead, types)))
+    if linear_keys:
+        batch = SeriesBatch([series_by_key[key] for key in linear_keys])
+        forecasts.update(zip(linear_keys, linear_forecasts(batch, months_ahead)))
+    return forecasts
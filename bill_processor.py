@@ -3,40 +3,98 @@ import re
 import json
 import numpy as np
 from datetime import datetime, timedelta
-from azure.ai.formrecognizer import DocumentAnalysisClient
-from azure.core.credentials import AzureKeyCredential
+from azure.core import MatchConditions
 from azure.cosmos import CosmosClient, exceptions
 from dotenv import load_dotenv
+from field_extractor import FieldExtractor, generate_diverse_date, PARSER_VERSION
+from extraction_cache import ExtractionCache
+from analysis_client import AnalysisClient, AnalysisThrottledError, merge_analyze_results
+from pdf_text import extract_text_layer, count_pages
+from document_fields import extract_document_fields
+from bill_stats import (
+    STATS_QUERY, TYPE_STATS_QUERY, compute_monthly_stats, compute_type_stats, type_stats_from_query
+)
+from bill_aggregates import (
+    AGGREGATES_SOURCE_QUERY, AGGREGATES_SCHEMA, aggregates_id, apply_bill, build_aggregates, count_bills,
+    monthly_stats, monthly_series, all_monthly_series, all_usage_series, consumption_series
+)
+from bill_forecast import (
+    SeriesBatch, forecast_series, linear_forecasts, advanced_forecasts, forecasts_id, truncate_forecast
+)
+from forecast_cache import ForecastCache, Uncached
+from forecast_models import fit_series, forecast_with_model
+from consumption_forecast import forecast_usage, apply_tariff
 
 load_dotenv()
 
+# Proiezioni predefinite delle query sulle bollette: il testo OCR (extracted_text)
+# si legge solo nella vista di dettaglio (get_bill o fields=None)
+BILL_LIST_FIELDS = [
+    'id', 'user_id', 'filename', 'upload_date', 'bill_type', 'supplier', 'amount', 'bill_date',
+    'due_date', 'billing_period', 'consumption', 'account_number', 'extraction_confidence',
+    'manual_review_needed', 'extracted_data', 'content_hash', 'extraction_method',
+    'field_sources'
+]
+BILL_FORECAST_FIELDS = ['bill_type', 'amount', 'due_date', 'upload_date', 'extracted_data']
+BILL_TRENDS_FIELDS = ['bill_type', 'amount', 'due_date', 'upload_date', 'extracted_data', 'consumption']
+
+MOCK_FORECAST_SEED = 42
+
+FIELD_NAME_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+def build_select_clause(fields=None):
+    """SELECT con i soli campi richiesti (SELECT * se fields è None)"""
+    if fields is None:
+        return "SELECT *"
+    invalid = [field for field in fields if not FIELD_NAME_PATTERN.match(field)]
+    if invalid:
+        raise ValueError(f"Campi non validi nella proiezione: {', '.join(invalid)}")
+    return "SELECT " + ", ".join(f"c.{field}" for field in fields)
+
 class BillProcessor:
-    def __init__(self):
+    def __init__(self, init_services=True):
         # Configurazione Azure Form Recognizer
         self.form_recognizer_endpoint = os.getenv('AZURE_FORM_RECOGNIZER_ENDPOINT')
         self.form_recognizer_key = os.getenv('AZURE_FORM_RECOGNIZER_KEY')
+        # prebuilt-invoice restituisce anche importo, scadenza e fornitore come campi strutturati
+        self.form_recognizer_model = os.getenv('AZURE_FORM_RECOGNIZER_MODEL', 'prebuilt-invoice')
+        # Pagine analizzate per prime (0 = documento intero): totale, scadenza e fornitore sono quasi sempre lì
+        self.form_recognizer_first_pages = int(os.getenv('FORM_RECOGNIZER_FIRST_PAGES', 2))
         
         # Configurazione Cosmos DB
         self.cosmos_endpoint = os.getenv('AZURE_COSMOS_ENDPOINT')
         self.cosmos_key = os.getenv('AZURE_COSMOS_KEY')
         self.database_name = os.getenv('AZURE_COSMOS_DATABASE_NAME', 'bills_management')
         self.container_name = os.getenv('AZURE_COSMOS_CONTAINER_NAME', 'bills')
+        self.aggregates_container_name = os.getenv('AZURE_COSMOS_AGGREGATES_CONTAINER_NAME', 'bill_aggregates')
         
         # Inizializza i client se configurati
         self.form_client = None
         self.cosmos_client = None
         self.container = None
+        self.aggregates_container = None
         
-        self._init_services()
+        # Estrattore dei campi con pattern precompilati
+        self.field_extractor = FieldExtractor()
+        
+        # Risultati OCR grezzi per hash del PDF (rielaborazione senza Form Recognizer)
+        self.extraction_cache = ExtractionCache()
+        
+        # Previsioni e trend memorizzati per versione dei dati dell'utente
+        self.forecast_cache = ForecastCache()
+        
+        # Senza servizi (es. worker di rielaborazione) restano disponibili estrazione e cache OCR
+        if init_services:
+            self._init_services()
     
     def _init_services(self):
         try:
             # Inizializza Form Recognizer
             if self.form_recognizer_endpoint and self.form_recognizer_key:
-                credential = AzureKeyCredential(self.form_recognizer_key)
-                self.form_client = DocumentAnalysisClient(
-                    endpoint=self.form_recognizer_endpoint, 
-                    credential=credential
+                # Client asincrono con concorrenza e TPS limitati, condiviso da app e job
+                self.form_client = AnalysisClient(
+                    self.form_recognizer_endpoint,
+                    self.form_recognizer_key
                 )
             
             # Inizializza Cosmos DB
@@ -58,63 +116,141 @@ class BillProcessor:
                     offer_throughput=400
                 )
                 
+                # Aggregati materializzati per utente (un documento per utente)
+                self.aggregates_container = database.create_container_if_not_exists(
+                    id=self.aggregates_container_name,
+                    partition_key=partition_key_config
+                )
+                
         except Exception as e:
             pass
     
-    def extract_bill_data(self, pdf_stream, filename, user_id):
-        if not self.form_client:
-            return self._extract_data_manual(pdf_stream, filename, user_id)
+    def extract_bill_data(self, pdf_stream, filename, user_id, content_hash=None):
+        # Risultato OCR già in cache per questo PDF: nessuna nuova analisi
+        result = self._get_cached_result(content_hash)
+        
+        pdf_stream.seek(0)
+        pdf_bytes = pdf_stream.read()
+        
+        # PDF digitale: testo incorporato ed estrattori locali, senza chiamare Form Recognizer
+        text_layer = None
+        if result is None:
+            text_layer = self._read_text_layer(pdf_bytes)
+            if text_layer:
+                local_data = self._build_bill_data(text_layer, filename, user_id, 'medium', 'text_layer')
+                # Tutti i campi critici trovati: nessuna escalation a Form Recognizer
+                if not self._missing_critical_fields(local_data):
+                    return self._store_extraction(local_data, content_hash)
+        
+        if result is None and not self.form_client:
+            return self._extract_data_manual(pdf_bytes, filename, user_id, text_layer, content_hash)
         
         try:
-            # Analizza il documento con Form Recognizer
-            pdf_stream.seek(0)
-            poller = self.form_client.begin_analyze_document(
-                "prebuilt-document", 
-                pdf_stream
-            )
-            result = poller.result()
+            if result is None:
+                # PDF scansionato o estrazione locale incompleta: analisi con Form Recognizer
+                result = self._analyze_document(pdf_bytes)
+                self.extraction_cache.put(content_hash, result, self.form_recognizer_model)
             
             # Estrai i dati del documento
             extracted_data = self._parse_form_recognizer_result(result, filename, user_id)
+            return self._store_extraction(extracted_data, content_hash)
             
-            # Salva nel database
-            if self.container:
-                self._save_to_cosmos(extracted_data)
-            
-            return extracted_data
-            
+        except AnalysisThrottledError:
+            # Quota esaurita: il chiamante deve riprovare più tardi, non perdere l'estrazione
+            raise
         except Exception as e:
             # Fallback a estrazione manuale
-            return self._extract_data_manual(pdf_stream, filename, user_id)
+            return self._extract_data_manual(pdf_bytes, filename, user_id, text_layer, content_hash)
+    
+    def _analyze_document(self, pdf_bytes):
+        """Analizza le prime pagine e il resto del documento solo se mancano campi critici"""
+        first_pages = self.form_recognizer_first_pages
+        page_count = count_pages(pdf_bytes)
+        if not first_pages or (page_count is not None and page_count <= first_pages):
+            return self.form_client.analyze_sync(pdf_bytes, self.form_recognizer_model)
+        
+        result = self.form_client.analyze_sync(pdf_bytes, self.form_recognizer_model, pages=f"1-{first_pages}")
+        # Documento più corto dell'intervallo o campi critici già trovati: niente seconda analisi
+        if len(result.pages) < first_pages:
+            return result
+        preview = self._parse_form_recognizer_result(result, '', '')
+        if not self._missing_critical_fields(preview):
+            return result
+        
+        if page_count is None:
+            # Numero di pagine sconosciuto (pypdf non disponibile): analisi completa
+            return self.form_client.analyze_sync(pdf_bytes, self.form_recognizer_model)
+        
+        remaining = self.form_client.analyze_sync(
+            pdf_bytes, self.form_recognizer_model, pages=f"{first_pages + 1}-{page_count}"
+        )
+        return merge_analyze_results(result, remaining)
+    
+    def _get_cached_result(self, content_hash):
+        """Risultato OCR in cache per il modello configurato o, per i PDF più vecchi, per prebuilt-document"""
+        for model_id in dict.fromkeys([self.form_recognizer_model, 'prebuilt-document']):
+            result = self.extraction_cache.get(content_hash, model_id)
+            if result is not None:
+                return result
+        return None
+    
+    def _read_text_layer(self, pdf_bytes):
+        """Testo incorporato nel PDF o stringa vuota se scansionato/non leggibile"""
+        return extract_text_layer(pdf_bytes) or ''
+    
+    def _store_extraction(self, bill_data, content_hash=None):
+        # Hash del contenuto per riconoscere i PDF caricati più volte
+        if content_hash:
+            bill_data['content_hash'] = content_hash
+        
+        # Salva nel database
+        if self.container:
+            # Stesso PDF già salvato (es. estrazione a bassa confidenza rifatta): si sostituisce il documento
+            existing = self.find_bill_by_hash(bill_data['user_id'], content_hash, include_low_confidence=True)
+            if existing:
+                bill_data['id'] = existing['id']
+                self._replace_in_cosmos(bill_data)
+            else:
+                self._save_to_cosmos(bill_data)
+        
+        return bill_data
     
     def _parse_form_recognizer_result(self, result, filename, user_id):   
         # Combina tutto il testo per l'analisi
-        full_text = ""
-        for page in result.pages:
-            for line in page.lines:
-                full_text += line.content + " "
+        full_text = " ".join(line.content for page in result.pages for line in page.lines)
+        
+        # Campi strutturati (modello invoice, coppie chiave-valore, tabelle) prima delle regex
+        known_fields, sources = extract_document_fields(result, self.field_extractor)
+        
+        return self._build_bill_data(full_text, filename, user_id, 'medium', 'form_recognizer',
+                                     known_fields, sources)
+    
+    def _build_bill_data(self, full_text, filename, user_id, confidence, method,
+                         known_fields=None, sources=None):
+        """Documento della bolletta dal testo, qualunque sia la sua provenienza"""
+        # Cerca pattern comuni nelle bollette italiane (solo i campi non già noti, in un solo passaggio)
+        fields = self.field_extractor.extract(full_text, known_fields)
+        sources = sources or {}
         
-        # Cerca pattern comuni nelle bollette italiane
         bill_data = {
             'id': f"{user_id}_{filename}_{int(datetime.now().timestamp())}",
             'user_id': user_id,
             'filename': filename,
             'upload_date': datetime.now().isoformat(),
             'extracted_text': full_text,
-            'bill_type': self._detect_bill_type(full_text),
-            'supplier': self._extract_supplier(full_text),
-            'amount': self._extract_amount(full_text),
-            'bill_date': self._extract_bill_date(full_text),  # Data della bolletta
-            'due_date': self._extract_due_date(full_text),
-            'billing_period': self._extract_billing_period(full_text),
-            'consumption': self._extract_consumption(full_text),
-            'account_number': self._extract_account_number(full_text),
-            'extraction_confidence': 'medium',  # Form Recognizer risultato
+            **fields,
+            'extraction_confidence': confidence,
+            'extraction_method': method,
+            # Provenienza di ogni campo trovato: invoice, key_value, table o regex
+            'field_sources': {
+                field: sources.get(field, 'regex') for field, value in fields.items() if value is not None
+            },
             'manual_review_needed': False,
+            'parser_version': PARSER_VERSION,
             'extracted_data': {
-                'date': self._extract_bill_date(full_text),  # Per compatibilità
-                'amount': self._extract_amount(full_text),
-                'supplier': self._extract_supplier(full_text)
+                'date': fields['bill_date'],  # Per compatibilità
+                'amount': fields['amount'],
+                'supplier': fields['supplier']
             }
         }
         
@@ -123,8 +259,42 @@ class BillProcessor:
         
         return bill_data
     
-    def _extract_data_manual(self, pdf_stream, filename, user_id):
+    def reprocess_bill(self, bill):
+        """Rielabora una bolletta dal risultato OCR in cache o dal testo salvato. Ritorna il documento aggiornato o None"""
+        result = self._get_cached_result(bill.get('content_hash'))
+        if result is not None:
+            updated = self._parse_form_recognizer_result(result, bill['filename'], bill['user_id'])
+        elif bill.get('extracted_text'):
+            # Nessun OCR in cache: regole applicate al testo salvato nella bolletta (incorporato o
+            # dell'OCR); i campi strutturati del modello (invoice, chiave-valore, tabelle) restano validi
+            sources = {
+                field: source for field, source in (bill.get('field_sources') or {}).items() if source != 'regex'
+            }
+            updated = self._build_bill_data(
+                bill['extracted_text'], bill['filename'], bill['user_id'],
+                bill.get('extraction_confidence', 'medium'), bill.get('extraction_method', 'form_recognizer'),
+                {field: bill.get(field) for field in sources}, sources
+            )
+        else:
+            return None
+        
+        # Identità e metadati originali restano invariati
+        for field in ['id', 'upload_date', 'content_hash']:
+            updated[field] = bill.get(field)
+        return updated
+    
+    def _extract_data_manual(self, pdf_bytes, filename, user_id, text_layer=None, content_hash=None):
         """Estrazione dati di fallback senza Form Recognizer"""
+        if text_layer is None:
+            text_layer = self._read_text_layer(pdf_bytes)
+        
+        # Testo incorporato disponibile: meglio dei soli campi vuoti, anche se incompleto
+        if text_layer:
+            return self._store_extraction(
+                self._build_bill_data(text_layer, filename, user_id, 'basso', 'text_layer'),
+                content_hash
+            )
+        
         return {
             'id': f"{user_id}_{filename}_{int(datetime.now().timestamp())}",
             'user_id': user_id,
@@ -144,259 +314,354 @@ class BillProcessor:
     
     def _detect_bill_type(self, text):
         """Rileva il tipo di bolletta dal testo"""
-        text_lower = text.lower()
-        
-        if any(word in text_lower for word in ['enel', 'energia elettrica', 'kwh', 'elettricità']):
-            return 'electricity'
-        elif any(word in text_lower for word in ['gas', 'metano', 'smc', 'gas naturale']):
-            return 'gas'
-        elif any(word in text_lower for word in ['acqua', 'idrico', 'mc acqua', 'servizio idrico']):
-            return 'water'
-        elif any(word in text_lower for word in ['telefono', 'tim', 'vodafone', 'wind', 'iliad']):
-            return 'telecom'
-        elif any(word in text_lower for word in ['internet', 'fibra', 'adsl']):
-            return 'internet'
-        elif any(word in text_lower for word in ['rifiuti', 'tari', 'spazzatura']):
-            return 'waste'
-        else:
-            return 'other'
+        return self.field_extractor.detect_bill_type(text)
     
     def _extract_supplier(self, text):
         """Estrae il nome del fornitore"""
-        suppliers = [
-            'ENEL', 'ENI', 'IREN', 'A2A', 'ACEA', 'HERA', 'EDISON',
-            'TIM', 'VODAFONE', 'WIND', 'ILIAD', 'FASTWEB',
-            'ACQUEDOTTO', 'VERITAS', 'CAP'
-        ]
-        
-        for supplier in suppliers:
-            if supplier.lower() in text.lower():
-                return supplier
-        
-        return None
+        return self.field_extractor.extract_supplier(text)
     
     def _extract_amount(self, text):
         """Estrae l'importo totale"""
-        # Pattern per importi in euro
-        patterns = [
-            r'totale[:\s]+€?\s*(\d+[.,]\d{2})',
-            r'importo[:\s]+€?\s*(\d+[.,]\d{2})',
-            r'€\s*(\d+[.,]\d{2})',
-            r'(\d+[.,]\d{2})\s*€'
-        ]
-        
-        for pattern in patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            if matches:
-                # Prendi l'importo più alto (probabilmente il totale)
-                amounts = [float(match.replace(',', '.')) for match in matches]
-                return max(amounts)
-        
-        return None
+        return self.field_extractor.extract_amount(text)
     
     def _extract_bill_date(self, text):
         """Estrae la data della bolletta (data di emissione)"""
-        patterns = [
-            r'data[:\s]+(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{4})',
-            r'emissione[:\s]+(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{4})',
-            r'fattura del[:\s]+(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{4})',
-            r'bolletta del[:\s]+(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{4})',
-            r'periodo[:\s]+.*?al[:\s]+(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{4})',
-            r'dal[:\s]+\d{1,2}[\/\-]\d{1,2}[\/\-]\d{4}[:\s]+al[:\s]+(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{4})',
-            # Pattern per date in formato diverso
-            r'(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{4})'  # Qualsiasi data come fallback
-        ]
-        
-        for pattern in patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            if matches:
-                try:
-                    date_str = matches[0]
-                    # Prova diversi formati
-                    for fmt in ['%d/%m/%Y', '%d-%m-%Y', '%Y-%m-%d']:
-                        try:
-                            parsed_date = datetime.strptime(date_str, fmt)
-                            # Verifica che la data sia ragionevole (non nel futuro, non troppo vecchia)
-                            if parsed_date <= datetime.now() and parsed_date.year >= 2020:
-                                return parsed_date.strftime('%Y-%m-%d')
-                        except:
-                            continue
-                except:
-                    continue
-        
-        # Se non trova nessuna data valida, usa una data simulata basata sull'upload
-        # Per diversificare le date, usiamo il contenuto per creare date diverse
-        fallback_date = self._generate_diverse_date(text)
-        return fallback_date.strftime('%Y-%m-%d')
+        return self.field_extractor.extract_bill_date(text)
     
     def _generate_diverse_date(self, text):
         """Genera date diverse basate sul contenuto per evitare che tutte finiscano nello stesso mese"""
-        # Usa l'hash del testo per generare una data consistente ma diversa
-        import hashlib
-        text_hash = hashlib.md5(text.encode()).hexdigest()
-        hash_int = int(text_hash[:8], 16)
-        
-        # Genera date negli ultimi 12 mesi, distribuendo per MESI diversi
-        base_date = datetime.now()
-        months_back = (hash_int % 12) + 1  # Da 1 a 12 mesi fa
-        day_in_month = (hash_int % 28) + 1  # Giorno del mese (1-28 per evitare problemi con febbraio)
-        
-        # Sottrai i mesi dalla data base
-        target_month = base_date.month - months_back
-        target_year = base_date.year
-        
-        # Gestisci il cambio di anno
-        while target_month <= 0:
-            target_month += 12
-            target_year -= 1
-        
-        try:
-            return datetime(target_year, target_month, day_in_month)
-        except ValueError:
-            # Fallback se la data non è valida
-            return base_date - timedelta(days=months_back * 30)
+        return generate_diverse_date(text)
     
     def _extract_due_date(self, text):
         """Estrae la data di scadenza"""
-        patterns = [
-            r'scadenza[:\s]+(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{4})',
-            r'entro[:\s]+(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{4})',
-            r'pagare entro[:\s]+(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{4})'
-        ]
-        
-        for pattern in patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            if matches:
-                try:
-                    date_str = matches[0]
-                    # Prova diversi formati
-                    for fmt in ['%d/%m/%Y', '%d-%m-%Y']:
-                        try:
-                            return datetime.strptime(date_str, fmt).isoformat()
-                        except:
-                            continue
-                except:
-                    continue
-        
-        return None
+        return self.field_extractor.extract_due_date(text)
     
     def _extract_billing_period(self, text):
         """Estrae il periodo di fatturazione"""
-        patterns = [
-            r'periodo[:\s]+(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{4})\s*[aA-]\s*(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{4})',
-            r'dal[:\s]+(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{4})\s*al[:\s]+(\d{1,2}[\/\-]\d{1,2}[\/\-]\d{4})'
-        ]
-        
-        for pattern in patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            if matches:
-                return {
-                    'start_date': matches[0][0],
-                    'end_date': matches[0][1]
-                }
-        
-        return None
+        return self.field_extractor.extract_billing_period(text)
     
     def _extract_consumption(self, text):
         """Estrae i consumi"""
-        consumptions = {}
-        
-        # Elettricità (kWh)
-        kwh_pattern = r'(\d+[.,]?\d*)\s*kwh'
-        kwh_matches = re.findall(kwh_pattern, text, re.IGNORECASE)
-        if kwh_matches:
-            consumptions['electricity_kwh'] = float(kwh_matches[-1].replace(',', '.'))
-        
-        # Gas (Smc)
-        gas_pattern = r'(\d+[.,]?\d*)\s*smc'
-        gas_matches = re.findall(gas_pattern, text, re.IGNORECASE)
-        if gas_matches:
-            consumptions['gas_smc'] = float(gas_matches[-1].replace(',', '.'))
-        
-        # Acqua (mc)
-        water_pattern = r'(\d+[.,]?\d*)\s*mc.*acqua'
-        water_matches = re.findall(water_pattern, text, re.IGNORECASE)
-        if water_matches:
-            consumptions['water_mc'] = float(water_matches[-1].replace(',', '.'))
-        
-        return consumptions if consumptions else None
+        return self.field_extractor.extract_consumption(text)
     
     def _extract_account_number(self, text):
         """Estrae il numero di utenza/contratto"""
-        patterns = [
-            r'utenza[:\s]+(\w+)',
-            r'contratto[:\s]+(\w+)',
-            r'cod[.\s]*cliente[:\s]+(\w+)'
-        ]
-        
-        for pattern in patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            if matches:
-                return matches[0]
-        
-        return None
+        return self.field_extractor.extract_account_number(text)
+    
+    def _missing_critical_fields(self, bill_data):
+        """Campi critici (fornitore, importo, scadenza) non trovati"""
+        critical_fields = ['supplier', 'amount', 'due_date']
+        return [field for field in critical_fields if not bill_data.get(field)]
     
     def _needs_manual_review(self, bill_data):
         """Determina se la bolletta necessita revisione manuale"""
-        critical_fields = ['supplier', 'amount', 'due_date']
-        missing_fields = [field for field in critical_fields if not bill_data.get(field)]
-        
-        return len(missing_fields) > 1  # Se mancano più di 1 campo critico
+        return len(self._missing_critical_fields(bill_data)) > 1  # Se mancano più di 1 campo critico
     
     def _save_to_cosmos(self, bill_data):
         """Salva i dati estratti in Cosmos DB"""
         try:
             if self.container:
                 self.container.create_item(body=bill_data)
+                self._update_user_aggregates(bill_data)
+                self.forecast_cache.invalidate(bill_data['user_id'])
         except exceptions.CosmosResourceExistsError:
             pass
         except Exception as e:
             pass
     
-    def get_user_bills(self, user_id, limit=50):
-        """Recupera le bollette di un utente"""
+    def _replace_in_cosmos(self, bill_data):
+        """Sostituisce una bolletta già salvata e ricalcola gli aggregati"""
+        try:
+            self.container.upsert_item(body=bill_data)
+            # I valori precedenti sono già negli aggregati: ricostruzione invece dell'aggiornamento incrementale
+            self.rebuild_user_aggregates(bill_data['user_id'])
+            self.forecast_cache.invalidate(bill_data['user_id'])
+        except Exception as e:
+            pass
+    
+    def get_user_aggregates(self, user_id):
+        """Legge gli aggregati materializzati dell'utente (li ricostruisce se mancano)"""
+        if not self.aggregates_container:
+            return None
+        
+        try:
+            aggregates = self.aggregates_container.read_item(item=aggregates_id(user_id), partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return self.rebuild_user_aggregates(user_id)
+        except Exception as e:
+            return None
+        
+        # Aggregati salvati con uno schema precedente (es. senza le serie dei consumi)
+        if aggregates.get('schema', 1) < AGGREGATES_SCHEMA:
+            return self.rebuild_user_aggregates(user_id)
+        return aggregates
+    
+    def rebuild_user_aggregates(self, user_id):
+        """Ricalcola da zero gli aggregati dell'utente a partire dalle sue bollette"""
+        if not self.container or not self.aggregates_container:
+            return None
+        
+        try:
+            bills = self.container.query_items(
+                query=AGGREGATES_SOURCE_QUERY,
+                parameters=[{'name': '@user_id', 'value': user_id}],
+                partition_key=user_id
+            )
+            aggregates = self.aggregates_container.upsert_item(body=build_aggregates(user_id, bills))
+            self.forecast_cache.invalidate(user_id)
+            return aggregates
+        except Exception as e:
+            return None
+    
+    def _update_user_aggregates(self, bill_data, max_attempts=3):
+        """Aggiorna in modo incrementale gli aggregati dopo il salvataggio di una bolletta"""
+        if not self.aggregates_container:
+            return
+        
+        user_id = bill_data['user_id']
+        for attempt in range(max_attempts):
+            try:
+                aggregates = self.aggregates_container.read_item(item=aggregates_id(user_id), partition_key=user_id)
+            except exceptions.CosmosResourceNotFoundError:
+                # La ricostruzione include già la bolletta appena salvata
+                self.rebuild_user_aggregates(user_id)
+                return
+            
+            if aggregates.get('schema', 1) < AGGREGATES_SCHEMA:
+                self.rebuild_user_aggregates(user_id)
+                return
+            
+            apply_bill(aggregates, bill_data)
+            try:
+                # Concorrenza ottimistica: se un altro upload ha aggiornato il documento si riprova
+                self.aggregates_container.replace_item(
+                    item=aggregates['id'],
+                    body=aggregates,
+                    etag=aggregates['_etag'],
+                    match_condition=MatchConditions.IfNotModified
+                )
+                return
+            except exceptions.CosmosAccessConditionFailedError:
+                continue
+        
+        self.rebuild_user_aggregates(user_id)
+    
+    def _build_bills_query(self, user_id, bill_type=None, fields=BILL_LIST_FIELDS, limit=None):
+        """Query parametrizzata sulla partizione dell'utente, più recenti prima"""
+        select = build_select_clause(fields)
+        parameters = [{'name': '@user_id', 'value': user_id}]
+        
+        if limit is not None:
+            select = select.replace("SELECT", "SELECT TOP @limit", 1)
+            parameters.append({'name': '@limit', 'value': int(limit)})
+        
+        query = f"{select} FROM c WHERE c.user_id = @user_id"
+        if bill_type:
+            query += " AND c.bill_type = @bill_type"
+            parameters.append({'name': '@bill_type', 'value': bill_type})
+        query += " ORDER BY c.upload_date DESC"
+        
+        return query, parameters
+    
+    def get_user_bills(self, user_id, limit=50, fields=BILL_LIST_FIELDS):
+        """Recupera le bollette di un utente (solo i campi in fields, tutti se None)"""
         if not self.container:
             return []
         
         try:
-            query = f"SELECT * FROM c WHERE c.user_id = '{user_id}' ORDER BY c.upload_date DESC"
+            query, parameters = self._build_bills_query(user_id, fields=fields, limit=limit)
             items = list(self.container.query_items(
                 query=query,
-                enable_cross_partition_query=True,
-                max_item_count=limit
+                parameters=parameters,
+                partition_key=user_id
             ))
             return items
         except Exception as e:
             return []
     
-    def get_bills_by_type(self, user_id, bill_type, limit=50):
-        """Recupera bollette per tipo"""
+    def get_bills_by_type(self, user_id, bill_type, limit=50, fields=BILL_LIST_FIELDS):
+        """Recupera bollette per tipo (solo i campi in fields, tutti se None)"""
         if not self.container:
             return []
         
         try:
-            query = f"SELECT * FROM c WHERE c.user_id = '{user_id}' AND c.bill_type = '{bill_type}' ORDER BY c.upload_date DESC"
+            query, parameters = self._build_bills_query(user_id, bill_type, fields=fields, limit=limit)
             items = list(self.container.query_items(
                 query=query,
-                enable_cross_partition_query=True,
-                max_item_count=limit
+                parameters=parameters,
+                partition_key=user_id
             ))
             return items
         except Exception as e:
             return []
+    
+    def get_bills_page(self, user_id, bill_type=None, page_size=50, continuation_token=None, fields=BILL_LIST_FIELDS):
+        """Recupera una pagina di bollette. Ritorna (bollette, continuation token della pagina successiva)"""
+        if not self.container:
+            return [], None
+        
+        query, parameters = self._build_bills_query(user_id, bill_type, fields=fields)
+        pages = self.container.query_items(
+            query=query,
+            parameters=parameters,
+            partition_key=user_id,
+            max_item_count=page_size
+        ).by_page(continuation_token)
+        
+        page = next(pages, None)
+        if page is None:
+            return [], None
+        return list(page), pages.continuation_token
+    
+    def find_bill_by_hash(self, user_id, content_hash, include_low_confidence=False):
+        """Cerca una bolletta già estratta dallo stesso PDF (stesso hash del contenuto)"""
+        if not self.container or not content_hash:
+            return None
+        
+        try:
+            query = (
+                f"{build_select_clause(BILL_LIST_FIELDS)} FROM c "
+                "WHERE c.user_id = @user_id AND c.content_hash = @content_hash"
+            )
+            if not include_low_confidence:
+                # Le estrazioni di fallback non bloccano una nuova analisi (che poi le sostituisce)
+                query += " AND c.extraction_confidence != 'basso'"
+            
+            items = list(self.container.query_items(
+                query=query.replace("SELECT", "SELECT TOP 1", 1),
+                parameters=[
+                    {'name': '@user_id', 'value': user_id},
+                    {'name': '@content_hash', 'value': content_hash}
+                ],
+                partition_key=user_id
+            ))
+            return items[0] if items else None
+        except Exception as e:
+            return None
+    
+    def get_bill(self, user_id, bill_id):
+        """Recupera il documento completo di una bolletta, testo estratto compreso"""
+        if not self.container:
+            return None
+        
+        try:
+            return self.container.read_item(item=bill_id, partition_key=user_id)
+        except Exception as e:
+            return None
 
-    def generate_forecast(self, user_id, bill_type=None, months_ahead=3):
+    def get_bill_stats(self, user_id):
+        """Statistiche mensili e per tipo, lette dagli aggregati o calcolate con query proiettate"""
+        if not self.container:
+            return {'monthly_stats': {}, 'type_stats': {}}
+        
+        aggregates = self.get_user_aggregates(user_id)
+        if aggregates is not None:
+            return {
+                'monthly_stats': monthly_stats(aggregates),
+                'type_stats': aggregates['type_stats']
+            }
+        
+        parameters = [{'name': '@user_id', 'value': user_id}]
+        
+        try:
+            rows = list(self.container.query_items(
+                query=STATS_QUERY,
+                parameters=parameters,
+                partition_key=user_id
+            ))
+        except Exception as e:
+            return {'monthly_stats': {}, 'type_stats': {}}
+        
+        # I totali per tipo si chiedono a Cosmos (GROUP BY); se non disponibile si calcolano in locale
+        try:
+            type_stats = type_stats_from_query(self.container.query_items(
+                query=TYPE_STATS_QUERY,
+                parameters=parameters,
+                partition_key=user_id
+            ))
+        except Exception as e:
+            type_stats = compute_type_stats(rows)
+        
+        return {
+            'monthly_stats': compute_monthly_stats(rows),
+            'type_stats': type_stats
+        }
+
+    def _data_version(self, user_id):
+        """Versione dei dati dell'utente: ETag degli aggregati (cambia a ogni bolletta salvata)"""
+        aggregates = self.get_user_aggregates(user_id)
+        if aggregates is None:
+            return None
+        return aggregates.get('_etag') or aggregates.get('version')
+    
+    def generate_forecast(self, user_id, bill_type=None, months_ahead=3, model=None):
         """
         Genera previsioni per i prossimi mesi basate sui dati storici
         Utilizza algoritmi locali avanzati per il forecasting
+        (model: nome di un modello di forecast_models o 'auto'; default: scelta per lunghezza dello storico)
         """
+        data_version = self._data_version(user_id)
+        return self.forecast_cache.get_or_compute(
+            'forecast', user_id, (bill_type, months_ahead, model), data_version,
+            lambda: self._compute_forecast(user_id, bill_type, months_ahead, data_version, model)
+        )
+    
+    def get_precomputed_forecasts(self, user_id, months_ahead, data_version):
+        """Previsioni del calcolo notturno, solo se fatte sulla versione attuale dei dati"""
+        if not self.aggregates_container or data_version is None:
+            return None
+        
+        try:
+            document = self.aggregates_container.read_item(item=forecasts_id(user_id), partition_key=user_id)
+        except Exception as e:
+            return None
+        
+        if document.get('data_version') != data_version or document.get('months_ahead', 0) < months_ahead:
+            return None
+        
+        forecasts = {
+            bill_type: truncate_forecast(forecast, months_ahead)
+            for bill_type, forecast in document['forecasts'].items()
+        }
+        if document.get('total'):
+            forecasts[None] = truncate_forecast(document['total'], months_ahead)
+        return forecasts
+    
+    def _compute_forecast(self, user_id, bill_type=None, months_ahead=3, data_version=None, model=None):
+        if bill_type == 'all':
+            return self.generate_all_forecasts(user_id, months_ahead, data_version, model)
+        
         if not self.container:
             return self._generate_mock_forecast(months_ahead)
         
         try:
+            # Percorso veloce: serie mensile già pronta negli aggregati materializzati
+            aggregates = self.get_user_aggregates(user_id)
+            if aggregates is not None:
+                bill_count = count_bills(aggregates, bill_type)
+                if bill_type and bill_count == 0:
+                    return {
+                        'error': f'Nessuna bolletta di tipo "{bill_type}" trovata',
+                        'predictions': [],
+                        'trend': 'no_data',
+                        'confidence': 'none'
+                    }
+                if bill_count >= 3:
+                    # Previsione già calcolata dal job notturno sugli stessi dati (modello predefinito)
+                    if model is None:
+                        precomputed = self.get_precomputed_forecasts(user_id, months_ahead, data_version)
+                        if precomputed and bill_type in precomputed:
+                            return precomputed[bill_type]
+                    
+                    monthly_data = monthly_series(aggregates, bill_type)
+                    if len(monthly_data) >= 3:
+                        return self._forecast_from_monthly_data(
+                            monthly_data, months_ahead, bill_type, user_id, model, data_version
+                        )
+            
             # Recupera dati storici
             if bill_type:
-                bills = self.get_bills_by_type(user_id, bill_type, limit=100)
+                bills = self.get_bills_by_type(user_id, bill_type, limit=100, fields=BILL_FORECAST_FIELDS)
                 # Se non ci sono bollette per questo tipo, ritorna errore
                 if len(bills) == 0:
                     return {
@@ -406,7 +671,7 @@ class BillProcessor:
                         'confidence': 'none'
                     }
             else:
-                bills = self.get_user_bills(user_id, limit=100)
+                bills = self.get_user_bills(user_id, limit=100, fields=BILL_FORECAST_FIELDS)
             
             if len(bills) < 3:
                 return self._generate_mock_forecast(months_ahead, bills)
@@ -417,20 +682,84 @@ class BillProcessor:
             if len(monthly_data) < 3:
                 return self._generate_mock_forecast(months_ahead, bills)
             
-
-            forecast_data = self._calculate_linear_forecast(monthly_data, months_ahead, bill_type)
+            return self._forecast_from_monthly_data(
+                monthly_data, months_ahead, bill_type, user_id, model, data_version
+            )
             
-            if len(monthly_data) >= 6:
-                 # Usa algoritmo avanzato locale per dati sufficienti
-                forecast_data = self._calculate_advanced_local_forecast(monthly_data, months_ahead, bill_type)
+        except Exception as e:
+            # Previsione di ripiego dopo un errore: non va memorizzata
+            return Uncached(self._generate_mock_forecast(months_ahead, bills if 'bills' in locals() else None))
+    
+    def generate_all_forecasts(self, user_id, months_ahead=3, data_version=None, model=None):
+        """Previsioni per tutti i tipi di bolletta e per il totale con una sola lettura dello storico
+        (Uncached se il calcolo fallisce e si ripiega sulle previsioni simulate)"""
+        if not self.container:
+            return {'forecasts': {}, 'total': self._generate_mock_forecast(months_ahead)}
+        
+        bills_by_type = None
+        try:
+            aggregates = self.get_user_aggregates(user_id)
+            if aggregates is not None:
+                series_by_type = all_monthly_series(aggregates)
             else:
-                # Usa algoritmo semplice per pochi dati
-                forecast_data = self._calculate_linear_forecast(monthly_data, months_ahead)
+                bills = self.get_user_bills(user_id, limit=500, fields=BILL_FORECAST_FIELDS)
+                bills_by_type = self._group_bills_by_type(bills)
+                series_by_type = {
+                    bill_type: self._prepare_monthly_data(type_bills)
+                    for bill_type, type_bills in bills_by_type.items()
+                }
+                series_by_type[None] = self._prepare_monthly_data(bills)
+            
+            # Previsioni del job notturno se aggiornate, altrimenti tutte le serie con almeno 3 mesi
+            # in un'unica matrice mesi x tipi (il totale è una colonna in più)
+            forecasts = None
+            if model is None:
+                forecasts = self.get_precomputed_forecasts(user_id, months_ahead, data_version)
+            if forecasts is None:
+                ready = {bill_type: series for bill_type, series in series_by_type.items() if len(series) >= 3}
+                forecasts = self._forecast_series(user_id, ready, months_ahead, model, data_version)
+            
+            # Tipi con poco storico: previsione simulata sulle loro bollette, come per il singolo tipo
+            for bill_type in series_by_type:
+                if bill_type is None:
+                    continue
+                if bill_type not in forecasts:
+                    if bills_by_type is None:
+                        bills_by_type = self._group_bills_by_type(
+                            self.get_user_bills(user_id, limit=500, fields=BILL_FORECAST_FIELDS)
+                        )
+                    forecasts[bill_type] = self._generate_mock_forecast(months_ahead, bills_by_type.get(bill_type))
             
-            return forecast_data
+            total = forecasts.pop(None, None) or self._generate_mock_forecast(months_ahead)
+            return {'forecasts': forecasts, 'total': total}
             
         except Exception as e:
-            return self._generate_mock_forecast(months_ahead, bills if 'bills' in locals() else None)
+            return Uncached({'forecasts': {}, 'total': self._generate_mock_forecast(months_ahead)})
+    
+    def _group_bills_by_type(self, bills):
+        bills_by_type = {}
+        for bill in bills:
+            bills_by_type.setdefault(bill.get('bill_type') or 'unknown', []).append(bill)
+        return bills_by_type
+    
+    def _forecast_from_monthly_data(self, monthly_data, months_ahead, bill_type=None,
+                                    user_id=None, model=None, data_version=None):
+        """Sceglie l'algoritmo in base alla lunghezza della serie mensile (o usa il modello richiesto)"""
+        if len(monthly_data) < 2:
+            return self._generate_mock_forecast(months_ahead, None)
+        return self._forecast_series(user_id, {bill_type: monthly_data}, months_ahead, model, data_version)[bill_type]
+    
+    def _forecast_series(self, user_id, series_by_key, months_ahead, model=None, data_version=None):
+        """Previsioni di più serie; con un modello esplicito i parametri stimati restano in cache per versione dei dati"""
+        if model is None:
+            return forecast_series(series_by_key, months_ahead)
+        
+        # I parametri non dipendono dall'orizzonte: altre richieste sugli stessi dati non rifanno il fit
+        fitted = self.forecast_cache.get_or_compute(
+            'model_fit', user_id, (model,) + tuple(series_by_key), data_version,
+            lambda: fit_series(series_by_key, model)
+        )
+        return forecast_with_model(series_by_key, months_ahead, model, fitted=fitted)
     
     def _prepare_monthly_data(self, bills):
         """Prepara i dati mensili per l'analisi usando le date di scadenza come priorità"""
@@ -498,207 +827,13 @@ class BillProcessor:
         """Calcola previsioni usando regressione lineare semplice"""
         if len(monthly_data) < 2:
             return self._generate_mock_forecast(months_ahead, None)
-        
-        # Prepara i dati per numpy
-        x_values = np.arange(len(monthly_data))
-        y_values = np.array([data[1] for data in monthly_data])
-        
-        # Calcola la regressione lineare
-        coeffs = np.polyfit(x_values, y_values, 1)
-        slope, intercept = coeffs
-        
-        # Limita il slope per evitare crescite eccessive
-        avg_amount = np.mean(y_values)
-        max_slope = avg_amount * 0.05  # Massimo 5% di crescita per mese
-        slope = np.clip(slope, -max_slope, max_slope)
-        
-        # Genera previsioni
-        last_month = datetime.strptime(monthly_data[-1][0], '%Y-%m')
-        forecast_data = {
-            'predictions': [],
-            'trend': 'crescente' if slope > 0 else 'decrescente' if slope < 0 else 'stabile',
-            'confidence': 'media',
-            'historical_average': float(np.mean(y_values)),
-            'last_month_amount': float(y_values[-1]),
-            'debug_info': {
-                'original_slope': float(coeffs[0]),
-                'capped_slope': float(slope),
-                'data_points': len(monthly_data),
-                'amounts_range': f"{float(np.min(y_values)):.2f} - {float(np.max(y_values)):.2f}"
-            }
-        }
-        
-        for i in range(1, months_ahead + 1):
-            # Calcola il mese futuro in modo più preciso
-            current_year = last_month.year
-            current_month = last_month.month
-            
-            future_month_num = current_month + i
-            future_year = current_year
-            
-            while future_month_num > 12:
-                future_month_num -= 12
-                future_year += 1
-            
-            future_month = datetime(future_year, future_month_num, 1)
-            
-            # Predizione basata sulla tendenza lineare
-            x_future = len(monthly_data) + i - 1
-            predicted_amount = slope * x_future + intercept
-            
-            # Aggiungi variazione stagionale simulata più conservativa
-            # Modifica speciale per tipo di bolletta
-            if bill_type == 'gas':
-                if future_month.month in [7, 8]:  # Luglio e Agosto
-                    seasonal_factor = 0.4  # Gas molto più basso in estate
-                elif future_month.month in [12, 1, 2]:  # Inverno
-                    seasonal_factor = 1.3  # Gas più alto in inverno
-                else:
-                    seasonal_factor = 0.8  # Primavera/autunno più bassi
-            elif bill_type == 'electricity':
-                if future_month.month in [7, 8]:  # Luglio e Agosto
-                    seasonal_factor = 1.2  # Elettricità più alta in estate (climatizzazione)
-                elif future_month.month in [12, 1, 2]:  # Inverno
-                    seasonal_factor = 1.1  # Elettricità leggermente più alta in inverno
-                else:
-                    seasonal_factor = 1.0  # Stabile nelle altre stagioni
-            else:
-                # Default per altri tipi o quando non specificato
-                seasonal_factor = 1 + 0.05 * np.sin(2 * np.pi * future_month.month / 12)
-            
-            predicted_amount *= seasonal_factor
-            
-            # Normalizzazione verso la media storica per evitare derive eccessive
-            historical_avg = np.mean(y_values)
-            weight_to_avg = min(i * 0.1, 0.3)  # Peso crescente verso la media
-            predicted_amount = predicted_amount * (1 - weight_to_avg) + historical_avg * weight_to_avg
-            
-            # Assicurati che non sia negativo
-            predicted_amount = max(predicted_amount, 0)
-            
-            forecast_data['predictions'].append({
-                'month': future_month.strftime('%Y-%m'),
-                'month_name': future_month.strftime('%B %Y'),
-                'predicted_amount': round(predicted_amount, 2),
-                'confidence_interval': {
-                    'min': round(predicted_amount * 0.85, 2),
-                    'max': round(predicted_amount * 1.15, 2)
-                }
-            })
-        
-        return forecast_data
+        return linear_forecasts(SeriesBatch([monthly_data]), months_ahead, [bill_type])[0]
     
     def _calculate_advanced_local_forecast(self, monthly_data, months_ahead, bill_type):
+        """Trend lineare + EMA + stagionalità (serve almeno 6 mesi di storico)"""
         if len(monthly_data) < 6:
             return self._calculate_linear_forecast(monthly_data, months_ahead, bill_type)
-        
-        # Prepara i dati
-        amounts = np.array([data[1] for data in monthly_data])
-        x_values = np.arange(len(monthly_data))
-        
-        # 1. Calcola trend lineare
-        linear_coeffs = np.polyfit(x_values, amounts, 1)
-        slope, intercept = linear_coeffs
-        
-        # 2. Calcola media mobile esponenziale (più peso ai dati recenti)
-        alpha = 0.3 
-        ema = [amounts[0]]
-        for i in range(1, len(amounts)):
-            ema.append(alpha * amounts[i] + (1 - alpha) * ema[i-1])
-        
-        # 3. Detecta stagionalità se ci sono almeno 12 mesi
-        seasonal_pattern = {}
-        if len(monthly_data) >= 12:
-            for i, (month_str, amount) in enumerate(monthly_data):
-                month_num = datetime.strptime(month_str, '%Y-%m').month
-                if month_num not in seasonal_pattern:
-                    seasonal_pattern[month_num] = []
-                seasonal_pattern[month_num].append(amount)
-            
-            # Calcola fattori stagionali medi
-            for month_num in seasonal_pattern:
-                seasonal_pattern[month_num] = np.mean(seasonal_pattern[month_num])
-        
-        # 4. Adjustment per tipo bolletta
-        bill_type_factors = {
-            'electricity': {'winter': 1.1, 'summer': 1.15, 'other': 1.0},
-            'gas': {'winter': 1.2, 'summer': 0.8, 'other': 1.0},
-            'water': {'winter': 0.95, 'summer': 1.05, 'other': 1.0},
-            'telecom': {'winter': 1.0, 'summer': 1.0, 'other': 1.0}
-        }
-        
-        # Prepara forecast data
-        last_month = datetime.strptime(monthly_data[-1][0], '%Y-%m')
-        last_ema = ema[-1]
-        avg_amount = np.mean(amounts)
-        
-        forecast_data = {
-            'predictions': [],
-            'trend': 'crescente' if slope > 0 else 'decrescente' if slope < 0 else 'stabile',
-            'confidence': 'alta',
-            'historical_average': float(avg_amount),
-            'last_month_amount': float(amounts[-1]),
-            'algorithm': 'Advanced Local (Linear + EMA + Seasonal)'
-        }
-        
-        # Genera previsioni
-        for i in range(1, months_ahead + 1):
-            future_month = last_month + timedelta(days=30 * i)
-            
-            # Combinazione predizioni
-            x_future = len(monthly_data) + i - 1
-            linear_pred = slope * x_future + intercept
-            ema_pred = last_ema * (1 + slope/avg_amount * 0.05)
-            
-            base_prediction = 0.7 * linear_pred + 0.3 * ema_pred
-            
-            # Applica stagionalità se disponibile
-            if seasonal_pattern and future_month.month in seasonal_pattern:
-                seasonal_factor = seasonal_pattern[future_month.month] / avg_amount
-            else:
-                # Stagionalità simulata generica più conservativa
-                seasonal_factor = 1 + 0.08 * np.sin(2 * np.pi * future_month.month / 12)
-            
-            # Applica fattore tipo bolletta
-            if bill_type in bill_type_factors:
-                if future_month.month in [12, 1, 2]:  # Winter
-                    type_factor = bill_type_factors[bill_type]['winter']
-                elif future_month.month in [6, 7, 8]:  # Summer
-                    type_factor = bill_type_factors[bill_type]['summer']
-                else:
-                    type_factor = bill_type_factors[bill_type]['other']
-            else:
-                type_factor = 1.0
-            
-            # Predizione finale con damping per mesi futuri
-            predicted_amount = base_prediction * seasonal_factor * type_factor
-            
-            # Applica damping per evitare crescite eccessive nei mesi futuri
-            damping_factor = 1 / (1 + i * 0.02)  # Riduce l'effetto per mesi più lontani
-            predicted_amount *= damping_factor
-            
-            predicted_amount = max(predicted_amount, 0)
-            
-            # Intervalli di confidenza più stretti per algoritmo avanzato
-            confidence_margin = 0.12  # ±12%
-            
-            forecast_data['predictions'].append({
-                'month': future_month.strftime('%Y-%m'),
-                'month_name': future_month.strftime('%B %Y'),
-                'predicted_amount': round(predicted_amount, 2),
-                'confidence_interval': {
-                    'min': round(predicted_amount * (1 - confidence_margin), 2),
-                    'max': round(predicted_amount * (1 + confidence_margin), 2)
-                },
-                'algorithm_details': {
-                    'linear_component': round(linear_pred, 2),
-                    'ema_component': round(ema_pred, 2),
-                    'seasonal_factor': round(seasonal_factor, 3),
-                    'type_factor': round(type_factor, 3)
-                }
-            })
-        
-        return forecast_data
+        return advanced_forecasts(SeriesBatch([monthly_data]), months_ahead, [bill_type])[0]
 
     def _generate_mock_forecast(self, months_ahead, bills=None):
         """Genera previsioni di esempio quando non ci sono dati sufficienti"""
@@ -733,11 +868,13 @@ class BillProcessor:
             'note': f'Previsioni simulate basate su {len(bills) if bills else 0} bollette - carica più bollette per previsioni accurate'
         }
         
+        # Variazione simulata con seme fisso: stessi dati, stessa risposta (memorizzabile)
+        variations = np.random.default_rng(MOCK_FORECAST_SEED).normal(0, 0.1, months_ahead)  # 10% di variazione
+        
         for i in range(1, months_ahead + 1):
             future_month = current_date + timedelta(days=30 * i)
             
-            # Variazione casuale simulata
-            variation = np.random.normal(0, 0.1)  # 10% di variazione
+            variation = variations[i - 1]
             predicted_amount = base_amount * (1 + variation)
             
             # Effetto stagionale simulato
@@ -758,27 +895,24 @@ class BillProcessor:
 
     def get_consumption_trends(self, user_id, bill_type):
         """Analizza i trend di consumo per tipo di bolletta"""
-        bills = self.get_bills_by_type(user_id, bill_type, limit=50)
-        
-        if len(bills) < 2:
+        return self.forecast_cache.get_or_compute(
+            'trends', user_id, (bill_type,), self._data_version(user_id),
+            lambda: self._compute_consumption_trends(user_id, bill_type)
+        )
+    
+    def _compute_consumption_trends(self, user_id, bill_type):
+        aggregates = self.get_user_aggregates(user_id)
+        if aggregates is None:
+            bills = self.get_bills_by_type(user_id, bill_type, limit=50, fields=BILL_TRENDS_FIELDS)
+            # Stesse serie numeriche degli aggregati, calcolate in memoria sulle bollette lette
+            aggregates = build_aggregates(user_id, bills)
+        
+        if count_bills(aggregates, bill_type) < 2:
             return None
-        
-        monthly_consumption = {}
-        
-        for bill in bills:
-            try:
-                upload_date = datetime.fromisoformat(bill['upload_date'].replace('Z', '+00:00'))
-                month_key = upload_date.strftime('%Y-%m')
-                
-                consumption = bill.get('consumption')
-                if consumption:
-                    # Estrai valore numerico del consumo
-                    consumption_value = self._extract_numeric_value(str(consumption))
-                    if consumption_value > 0:
-                        monthly_consumption[month_key] = consumption_value
-            except:
-                continue
-        
+        return self._summarize_consumption_trend(consumption_series(aggregates, bill_type))
+    
+    def _summarize_consumption_trend(self, monthly_consumption):
+        """Trend degli ultimi 6 mesi a partire dai consumi {mese: valore}"""
         if len(monthly_consumption) < 2:
             return None
         
@@ -800,14 +934,47 @@ class BillProcessor:
         
         return None
     
-    def _extract_numeric_value(self, text):
-        """Estrae valore numerico da una stringa"""
-        numbers = re.findall(r'\d+[.,]?\d*', text)
-        if numbers:
-            try:
-                return float(numbers[0].replace(',', '.'))
-            except:
-                return 0
-        return 0
+    def generate_consumption_forecast(self, user_id, bill_type=None, months_ahead=3,
+                                      tariff_change=None, unit_price=None, model=None):
+        """
+        Previsione dei costi come consumi previsti x prezzo unitario previsto.
+        tariff_change (variazione % del prezzo) e unit_price (nuovo prezzo in euro per unità)
+        simulano un cambio di tariffa sulla stessa previsione dei consumi, che resta in cache.
+        """
+        usage_forecasts = self.forecast_cache.get_or_compute(
+            'consumption_forecast', user_id, (months_ahead, model), self._data_version(user_id),
+            lambda: self._compute_usage_forecasts(user_id, months_ahead, model)
+        )
+        
+        if bill_type:
+            if bill_type not in usage_forecasts:
+                return {
+                    'error': f'Consumi insufficienti per le bollette di tipo "{bill_type}"',
+                    'predictions': [],
+                    'trend': 'no_data',
+                    'confidence': 'none'
+                }
+            return apply_tariff(usage_forecasts[bill_type], tariff_change, unit_price)
+        
+        return {
+            'forecasts': {
+                usage_type: apply_tariff(usage_forecast, tariff_change)
+                for usage_type, usage_forecast in usage_forecasts.items()
+            }
+        }
+    
+    def _compute_usage_forecasts(self, user_id, months_ahead, model=None):
+        """Previsioni di consumi e prezzo unitario di tutti i tipi di bolletta in una sola passata"""
+        if not self.container:
+            return {}
+        
+        try:
+            aggregates = self.get_user_aggregates(user_id)
+            if aggregates is None:
+                bills = self.get_user_bills(user_id, limit=500, fields=BILL_TRENDS_FIELDS)
+                aggregates = build_aggregates(user_id, bills)
+            return forecast_usage(all_usage_series(aggregates), months_ahead, model)
+        except Exception as e:
+            return Uncached({})
     
 bill_processor = BillProcessor()
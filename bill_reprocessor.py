@@ -0,0 +1,243 @@
+"""Rielaborazione massiva delle bollette (dai risultati OCR in cache o dal testo salvato) e calcolo notturno delle previsioni.
+
+Uso (unico punto di ingresso: bill_processor resta un modulo importato, con un solo singleton):
+    python -m bill_reprocessor reprocess [--input export.jsonl] [--output updated.jsonl]
+                                         [--workers 4] [--batch-size 50] [--checkpoint reprocess.ckpt]
+    python -m bill_reprocessor forecast [--input export.jsonl] [--output forecasts.jsonl]
+                                        [--workers 4] [--months 12] [--chunk-size 100]
+"""
+import os
+import sys
+import json
+import argparse
+from multiprocessing import Pool
+from bill_processor import bill_processor, BillProcessor
+from field_extractor import PARSER_VERSION
+from forecast_batch import precompute_forecasts
+
+# Bollette estratte con una versione precedente delle regole; quelle senza OCR in cache né
+# testo salvato sono contate da reprocess come missing_cache
+STALE_BILLS_QUERY = (
+    "SELECT * FROM c WHERE NOT IS_DEFINED(c.parser_version) OR c.parser_version != @parser_version"
+)
+ALL_BILLS_QUERY = "SELECT * FROM c"
+
+_worker_processor = None
+
+
+def _init_worker():
+    # Ogni processo ha il proprio estrattore e la propria cache, senza client Cosmos
+    global _worker_processor
+    _worker_processor = BillProcessor(init_services=False)
+
+
+def _reprocess_one(bill):
+    try:
+        return _worker_processor.reprocess_bill(bill), None
+    except Exception as e:
+        return None, f"{bill.get('id')}: {e}"
+
+
+def needs_reprocess(bill, reprocess_all=False):
+    return reprocess_all or bill.get('parser_version') != PARSER_VERSION
+
+
+def iter_cosmos_pages(container, reprocess_all=False, page_size=200, continuation_token=None):
+    """Pagine di bollette da Cosmos DB: (bollette, token per riprendere dalla pagina successiva)"""
+    pages = container.query_items(
+        query=ALL_BILLS_QUERY if reprocess_all else STALE_BILLS_QUERY,
+        parameters=[] if reprocess_all else [{'name': '@parser_version', 'value': PARSER_VERSION}],
+        enable_cross_partition_query=True,
+        max_item_count=page_size
+    ).by_page(continuation_token)
+
+    for page in pages:
+        items = list(page)
+        yield items, pages.continuation_token
+
+
+def iter_jsonl_pages(path, page_size=200, start_line=0):
+    """Pagine di bollette da un export JSONL: (bollette, numero di riga da cui riprendere)"""
+    items = []
+    line_number = 0
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if line_number <= start_line or not line.strip():
+                continue
+            items.append(json.loads(line))
+            if len(items) >= page_size:
+                yield items, line_number
+                items = []
+    if items:
+        yield items, line_number
+
+
+class BulkWriter:
+    """Scrive le bollette aggiornate a blocchi: batch transazionali per partizione o file JSONL"""
+
+    def __init__(self, container=None, output_path=None, batch_size=50):
+        self.container = container
+        self.output_path = output_path
+        self.batch_size = min(batch_size, 100)  # Limite di Cosmos per batch transazionale
+        self._pending = {}
+        self.written = 0
+
+    def add(self, bill):
+        batch = self._pending.setdefault(bill['user_id'], [])
+        batch.append(bill)
+        if len(batch) >= self.batch_size:
+            self._flush_partition(bill['user_id'])
+
+    def flush(self):
+        for user_id in list(self._pending):
+            self._flush_partition(user_id)
+
+    def _flush_partition(self, user_id):
+        batch = self._pending.pop(user_id, [])
+        if not batch:
+            return
+
+        if self.output_path:
+            with open(self.output_path, 'a', encoding='utf-8') as f:
+                for bill in batch:
+                    f.write(json.dumps(bill, default=str) + '\n')
+        else:
+            try:
+                self.container.execute_item_batch(
+                    batch_operations=[('upsert', (bill,)) for bill in batch],
+                    partition_key=user_id
+                )
+            except Exception as e:
+                # Batch troppo grande o rifiutato: scrittura singola (su stderr, lo stdout resta JSON)
+                print(f"Batch di {len(batch)} documenti per '{user_id}' fallito ({e}): scrittura singola",
+                      file=sys.stderr)
+                for bill in batch:
+                    self.container.upsert_item(body=bill)
+        self.written += len(batch)
+
+
+def load_checkpoint(path, source):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        checkpoint = json.load(f)
+    # Un checkpoint di un'altra sorgente non è valido
+    return checkpoint if checkpoint.get('source') == source else None
+
+
+def save_checkpoint(path, checkpoint):
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def reprocess(processor, input_path=None, output_path=None, workers=None, batch_size=50,
+              page_size=200, checkpoint_path=None, reprocess_all=False):
+    """Rielabora le bollette in parallelo e scrive gli aggiornamenti a blocchi, con ripresa da checkpoint"""
+    source = f"jsonl:{os.path.abspath(input_path)}" if input_path else 'cosmos'
+    if not input_path and not processor.container:
+        raise RuntimeError('Cosmos DB non configurato: usa --input con un export JSONL')
+    if not output_path and not processor.container:
+        raise RuntimeError('Cosmos DB non configurato: usa --output per scrivere su file')
+
+    checkpoint = load_checkpoint(checkpoint_path, source) or {
+        'source': source,
+        'position': None,
+        'stats': {'processed': 0, 'updated': 0, 'skipped': 0, 'missing_cache': 0, 'errors': 0},
+        'touched_users': []
+    }
+    stats = checkpoint['stats']
+    touched_users = set(checkpoint['touched_users'])
+
+    if input_path:
+        pages = iter_jsonl_pages(input_path, page_size, checkpoint['position'] or 0)
+    else:
+        pages = iter_cosmos_pages(processor.container, reprocess_all, page_size, checkpoint['position'])
+
+    writer = BulkWriter(processor.container, output_path, batch_size)
+    with Pool(processes=workers or os.cpu_count(), initializer=_init_worker) as pool:
+        for bills, position in pages:
+            to_process = [bill for bill in bills if needs_reprocess(bill, reprocess_all)]
+            stats['processed'] += len(bills)
+            stats['skipped'] += len(bills) - len(to_process)
+
+            for bill, (updated, error) in zip(to_process, pool.imap(_reprocess_one, to_process, chunksize=8)):
+                if error:
+                    stats['errors'] += 1
+                elif updated is None:
+                    stats['missing_cache'] += 1
+                else:
+                    writer.add(updated)
+                    touched_users.add(bill['user_id'])
+                    stats['updated'] += 1
+
+            # Il checkpoint avanza solo quando la pagina è stata scritta
+            writer.flush()
+            checkpoint['position'] = position
+            checkpoint['touched_users'] = sorted(touched_users)
+            save_checkpoint(checkpoint_path, checkpoint)
+
+    # Gli importi possono essere cambiati: aggregati ricalcolati per gli utenti toccati
+    if not output_path:
+        for user_id in touched_users:
+            processor.rebuild_user_aggregates(user_id)
+
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Strumenti di manutenzione delle bollette')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    reprocess_parser = subparsers.add_parser('reprocess', help='Rielabora le bollette dai risultati OCR in cache o dal testo salvato')
+    reprocess_parser.add_argument('--input', help='Export JSONL delle bollette (default: Cosmos DB)')
+    reprocess_parser.add_argument('--output', help='Scrive le bollette aggiornate in JSONL invece che su Cosmos DB')
+    reprocess_parser.add_argument('--workers', type=int, default=None, help='Processi paralleli (default: numero di CPU)')
+    reprocess_parser.add_argument('--batch-size', type=int, default=50, help='Bollette per scrittura a blocchi')
+    reprocess_parser.add_argument('--page-size', type=int, default=200, help='Bollette lette per pagina')
+    reprocess_parser.add_argument('--checkpoint', default='reprocess.ckpt', help='File di checkpoint per la ripresa')
+    reprocess_parser.add_argument('--all', action='store_true', help='Rielabora anche le bollette già aggiornate')
+
+    forecast_parser = subparsers.add_parser('forecast', help='Precalcola le previsioni di tutti gli utenti')
+    forecast_parser.add_argument('--input', help='Export JSONL delle bollette (default: Cosmos DB)')
+    forecast_parser.add_argument('--output', help='Scrive le previsioni in JSONL invece che su Cosmos DB')
+    forecast_parser.add_argument('--workers', type=int, default=None, help='Processi paralleli (default: numero di CPU)')
+    forecast_parser.add_argument('--months', type=int, default=12, help='Mesi di previsione precalcolati')
+    forecast_parser.add_argument('--chunk-size', type=int, default=100, help='Utenti per calcolo vettoriale')
+    forecast_parser.add_argument('--batch-size', type=int, default=50, help='Documenti per scrittura a blocchi')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'reprocess':
+        stats = reprocess(
+            bill_processor,
+            input_path=args.input,
+            output_path=args.output,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            page_size=args.page_size,
+            checkpoint_path=args.checkpoint,
+            reprocess_all=args.all
+        )
+        print(json.dumps(stats))
+    elif args.command == 'forecast':
+        stats = precompute_forecasts(
+            bill_processor,
+            input_path=args.input,
+            output_path=args.output,
+            workers=args.workers,
+            months_ahead=args.months,
+            chunk_size=args.chunk_size,
+            batch_size=args.batch_size
+        )
+        print(json.dumps(stats))
+
+
+if __name__ == '__main__':
+    main()
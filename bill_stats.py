@@ -0,0 +1,100 @@
+import numpy as np
+from datetime import datetime
+
+# Campi necessari per le statistiche: evita di leggere extracted_text e il resto del documento
+STATS_QUERY = (
+    "SELECT c.due_date, c.amount, c.bill_type, c.upload_date, c.extracted_data.date AS extracted_date "
+    "FROM c WHERE c.user_id = @user_id"
+)
+
+# Conteggi e totali per tipo calcolati direttamente da Cosmos DB
+TYPE_STATS_QUERY = (
+    "SELECT c.bill_type, COUNT(1) AS count, SUM(IS_NUMBER(c.amount) ? c.amount : 0) AS total_amount "
+    "FROM c WHERE c.user_id = @user_id GROUP BY c.bill_type"
+)
+
+
+def parse_amount(value):
+    """Converte un importo (numero o stringa con € e virgola) in float, NaN se non valido"""
+    if not value:
+        return np.nan
+    try:
+        return float(str(value).replace(',', '.').replace('€', '').strip())
+    except ValueError:
+        return np.nan
+
+
+def resolve_bill_date(bill):
+    """Data di riferimento di una bolletta: scadenza, poi data estratta, poi data di upload"""
+    # Prima priorità: data di scadenza (due_date), già in formato ISO dalla estrazione
+    if bill.get('due_date'):
+        try:
+            return datetime.fromisoformat(bill['due_date'].replace('Z', '+00:00'))
+        except (ValueError, AttributeError):
+            pass
+
+    # Seconda priorità: data estratta (campo proiettato o documento completo)
+    date_str = bill.get('extracted_date')
+    if date_str is None and bill.get('extracted_data'):
+        date_str = bill['extracted_data'].get('date')
+    if date_str:
+        for fmt in ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%Y-%m-%d %H:%M:%S']:
+            try:
+                return datetime.strptime(date_str, fmt)
+            except (ValueError, TypeError):
+                continue
+
+    # Fallback: upload_date
+    if bill.get('upload_date'):
+        try:
+            return datetime.fromisoformat(bill['upload_date'].replace('Z', '+00:00'))
+        except (ValueError, AttributeError):
+            pass
+
+    return None
+
+
+def aggregate_by_key(keys, amounts):
+    """Raggruppa in modo vettoriale: {chiave: {'count', 'total_amount'}} (gli importi NaN contano zero)"""
+    if not keys:
+        return {}
+
+    unique_keys, inverse = np.unique(np.array(keys), return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(unique_keys))
+    totals = np.bincount(inverse, weights=np.nan_to_num(np.asarray(amounts, dtype=float)),
+                         minlength=len(unique_keys))
+
+    return {
+        str(key): {'count': int(count), 'total_amount': float(total)}
+        for key, count, total in zip(unique_keys, counts, totals)
+    }
+
+
+def compute_monthly_stats(bills):
+    """Numero di bollette e importo totale per mese (YYYY-MM)"""
+    keys = []
+    amounts = []
+    for bill in bills:
+        bill_date = resolve_bill_date(bill)
+        if bill_date:
+            keys.append(bill_date.strftime('%Y-%m'))
+            amounts.append(parse_amount(bill.get('amount')))
+    return aggregate_by_key(keys, amounts)
+
+
+def compute_type_stats(bills):
+    """Numero di bollette e importo totale per tipo di bolletta"""
+    keys = [bill.get('bill_type') or 'unknown' for bill in bills]
+    amounts = [parse_amount(bill.get('amount')) for bill in bills]
+    return aggregate_by_key(keys, amounts)
+
+
+def type_stats_from_query(rows):
+    """Converte il risultato della GROUP BY di Cosmos nel formato delle statistiche per tipo"""
+    type_stats = {}
+    for row in rows:
+        bill_type = row.get('bill_type') or 'unknown'
+        stats = type_stats.setdefault(bill_type, {'count': 0, 'total_amount': 0.0})
+        stats['count'] += row.get('count', 0)
+        stats['total_amount'] += float(row.get('total_amount') or 0)
+    return type_stats
@@ -0,0 +1,113 @@
+"""Previsioni dei costi a partire dai consumi (kWh, Smc, mc).
+
+Quantità consumate e prezzo unitario (importo / quantità) si prevedono separatamente
+per tutti i tipi di bolletta insieme: le quantità con i modelli di forecast_models,
+il prezzo con una media mobile esponenziale. Il costo è il prodotto dei due, quindi
+uno scenario di tariffa diversa (variazione percentuale o nuovo prezzo unitario)
+si applica alla previsione dei consumi già calcolata, senza rileggere lo storico.
+"""
+import numpy as np
+from bill_forecast import SeriesBatch, last_ema, series_means
+from forecast_models import forecast_with_model
+
+MIN_USAGE_POINTS = 3
+
+
+def unit_price_series(usage):
+    """Serie [(mese, prezzo unitario)] da [(mese, quantità, importo)]"""
+    return [(month, amount / quantity) for month, quantity, amount in usage if amount > 0]
+
+
+def forecast_usage(usage_by_type, months_ahead, model=None):
+    """Previsione di consumi e prezzo unitario per ogni tipo: {tipo: previsione dei consumi}.
+
+    usage_by_type è {tipo: (unità, [(mese, quantità, importo)])}; i tipi con meno di
+    MIN_USAGE_POINTS mesi di consumi sono esclusi.
+    """
+    ready = {
+        bill_type: (unit, usage) for bill_type, (unit, usage) in usage_by_type.items()
+        if len(usage) >= MIN_USAGE_POINTS and len(unit_price_series(usage)) > 0
+    }
+    if not ready:
+        return {}
+
+    # Consumi: una colonna per tipo, stessi modelli delle previsioni in euro
+    quantities = {bill_type: [(month, quantity) for month, quantity, _ in usage]
+                  for bill_type, (_, usage) in ready.items()}
+    unit_forecasts = forecast_with_model(quantities, months_ahead, model)
+
+    # Prezzo unitario: ultimo valore della media mobile esponenziale, per tutti i tipi insieme
+    price_batch = SeriesBatch([unit_price_series(usage) for _, usage in ready.values()])
+    prices = last_ema(price_batch)
+    average_prices = series_means(price_batch)
+
+    forecasts = {}
+    for column, (bill_type, (unit, usage)) in enumerate(ready.items()):
+        units = unit_forecasts[bill_type]
+        forecasts[bill_type] = {
+            'unit': unit,
+            'months': [p['month'] for p in units['predictions']],
+            'month_names': [p['month_name'] for p in units['predictions']],
+            'units': [p['predicted_amount'] for p in units['predictions']],
+            'units_min': [p['confidence_interval']['min'] for p in units['predictions']],
+            'units_max': [p['confidence_interval']['max'] for p in units['predictions']],
+            'units_trend': units['trend'],
+            'historical_average_units': units['historical_average'],
+            'unit_price': float(prices[column]),
+            'historical_unit_price': float(average_prices[column]),
+            'last_unit_price': float(price_batch.amounts[-1, column]),
+            'model': units.get('model') or units.get('algorithm', 'linear'),
+            'data_points': len(usage)
+        }
+    return forecasts
+
+
+def apply_tariff(usage_forecast, tariff_change=None, unit_price=None):
+    """Costi previsti da una previsione dei consumi, con uno scenario di tariffa opzionale.
+
+    tariff_change è la variazione percentuale del prezzo unitario previsto (es. 10 = +10%),
+    unit_price un nuovo prezzo unitario in euro che sostituisce quello previsto.
+    """
+    price = usage_forecast['unit_price'] if unit_price is None else float(unit_price)
+    if tariff_change is not None:
+        price *= 1 + float(tariff_change) / 100
+
+    units = np.array(usage_forecast['units'])
+    amounts = units * price
+    amounts_min = np.array(usage_forecast['units_min']) * price
+    amounts_max = np.array(usage_forecast['units_max']) * price
+    baseline = units * usage_forecast['unit_price']
+
+    forecast = {
+        'unit': usage_forecast['unit'],
+        'predictions': [],
+        'trend': usage_forecast['units_trend'],
+        'confidence': 'alta' if usage_forecast['data_points'] >= 6 else 'media',
+        'historical_average_units': usage_forecast['historical_average_units'],
+        'historical_unit_price': round(usage_forecast['historical_unit_price'], 4),
+        'last_unit_price': round(usage_forecast['last_unit_price'], 4),
+        'forecast_unit_price': round(usage_forecast['unit_price'], 4),
+        'unit_price': round(price, 4),
+        'model': usage_forecast['model'],
+        'algorithm': 'Consumption x Unit Price'
+    }
+    if tariff_change is not None or unit_price is not None:
+        forecast['scenario'] = {
+            'tariff_change': tariff_change,
+            'unit_price': unit_price,
+            'total_difference': round(float((amounts - baseline).sum()), 2)
+        }
+
+    for h, month in enumerate(usage_forecast['months']):
+        forecast['predictions'].append({
+            'month': month,
+            'month_name': usage_forecast['month_names'][h],
+            'predicted_units': round(float(units[h]), 2),
+            'unit_price': round(price, 4),
+            'predicted_amount': round(float(amounts[h]), 2),
+            'confidence_interval': {
+                'min': round(float(amounts_min[h]), 2),
+                'max': round(float(amounts_max[h]), 2)
+            }
+        })
+    return forecast
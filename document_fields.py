@@ -0,0 +1,176 @@
+import re
+from datetime import date, datetime
+
+# Campi del modello prebuilt-invoice per ciascun campo della bolletta (in ordine di priorità)
+INVOICE_FIELDS = {
+    'amount': ['AmountDue', 'InvoiceTotal'],
+    'due_date': ['DueDate'],
+    'bill_date': ['InvoiceDate'],
+    'supplier': ['VendorName'],
+    'account_number': ['CustomerId'],
+}
+
+# Chiavi delle coppie chiave-valore (e delle celle di tabella) per ciascun campo, in ordine di priorità.
+# Una parola chiave vale se la chiave inizia con essa ("Totale da pagare entro il" -> amount)
+KEY_VALUE_KEYWORDS = {
+    'amount': ['totale da pagare', 'importo da pagare', 'totale bolletta', 'totale fattura',
+               'importo totale', 'totale'],
+    'due_date': ['data scadenza', 'data di scadenza', 'scadenza', 'da pagare entro', 'pagare entro'],
+    'bill_date': ['data emissione', 'data di emissione', 'data fattura', 'data documento', 'emessa il'],
+    'account_number': ['codice cliente', 'numero cliente', 'codice utenza', 'numero utenza',
+                       'codice contratto', 'numero contratto', 'cod cliente', 'cod utenza',
+                       'n cliente', 'n utenza'],
+}
+
+# Parole chiave generiche valide solo come chiave intera: "Totale IVA" o "Totale imponibile" non sono l'importo
+KEY_VALUE_WHOLE_KEYS = {'totale'}
+KEY_SEPARATORS = re.compile(r'[^\w]+')
+
+AMOUNT_VALUE = re.compile(r'(\d{1,3}(?:\.\d{3})+,\d{2}|\d+[.,]\d{2})')
+DATE_VALUE = re.compile(r'(\d{1,2}[/.-]\d{1,2}[/.-]\d{4}|\d{4}-\d{2}-\d{2})')
+ACCOUNT_VALUE = re.compile(r'([A-Z0-9]{5,})', re.IGNORECASE)
+
+
+def parse_amount_value(value):
+    match = AMOUNT_VALUE.search(value or '')
+    if not match:
+        return None
+    amount = match.group(1)
+    if ',' in amount:
+        # Formato italiano: punto per le migliaia, virgola per i decimali
+        amount = amount.replace('.', '').replace(',', '.')
+    return float(amount)
+
+
+def parse_date_value(value):
+    match = DATE_VALUE.search(value or '')
+    if not match:
+        return None
+    date_str = match.group(1)
+    for fmt in ['%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%Y-%m-%d']:
+        try:
+            return datetime.strptime(date_str, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def parse_account_value(value):
+    match = ACCOUNT_VALUE.search(value or '')
+    return match.group(1) if match else None
+
+
+def _format_field(field, value):
+    """Converte il valore nel formato prodotto dagli estrattori regex"""
+    if value is None:
+        return None
+    if field == 'amount':
+        return float(value) if isinstance(value, (int, float)) else parse_amount_value(str(value))
+    if field in ('due_date', 'bill_date'):
+        if isinstance(value, date) and not isinstance(value, datetime):
+            value = datetime(value.year, value.month, value.day)
+        elif not isinstance(value, datetime):
+            value = parse_date_value(str(value))
+        if value is None:
+            return None
+        return value.isoformat() if field == 'due_date' else value.strftime('%Y-%m-%d')
+    if field == 'account_number':
+        return parse_account_value(str(value))
+    return str(value).strip() or None
+
+
+def _invoice_value(document_field):
+    value = document_field.value
+    if document_field.value_type == 'currency':
+        return value.amount if value is not None else None
+    return value
+
+
+def fields_from_invoice(result):
+    """Campi dal documento analizzato con prebuilt-invoice"""
+    fields = {}
+    for document in getattr(result, 'documents', None) or []:
+        for field, names in INVOICE_FIELDS.items():
+            if field in fields:
+                continue
+            for name in names:
+                document_field = document.fields.get(name)
+                if document_field is None:
+                    continue
+                value = _format_field(field, _invoice_value(document_field))
+                if value is not None:
+                    fields[field] = value
+                    break
+    return fields
+
+
+def _match_key(key):
+    """Campo e priorità della chiave (più basso è meglio) o None"""
+    # Solo parole: "Totale (€):" -> "totale", "Cod. cliente" -> "cod cliente"
+    key = ' '.join(KEY_SEPARATORS.sub(' ', key.lower()).split())
+    best = None
+    for field, keywords in KEY_VALUE_KEYWORDS.items():
+        for rank, keyword in enumerate(keywords):
+            if keyword in KEY_VALUE_WHOLE_KEYS:
+                matched = key == keyword
+            else:
+                matched = key == keyword or key.startswith(keyword + ' ')
+            if matched and (best is None or rank < best[1]):
+                best = (field, rank)
+                break
+    return best
+
+
+def _collect_pairs(result):
+    """Coppie (chiave, valore, sorgente) da key_value_pairs e dalle righe delle tabelle"""
+    for pair in getattr(result, 'key_value_pairs', None) or []:
+        if pair.key and pair.value:
+            yield pair.key.content, pair.value.content, 'key_value'
+
+    for table in getattr(result, 'tables', None) or []:
+        cells = {(cell.row_index, cell.column_index): cell.content for cell in table.cells}
+        for (row, column), content in cells.items():
+            # Etichetta in una cella e valore nella cella a destra
+            value = cells.get((row, column + 1))
+            if content and value:
+                yield content, value, 'table'
+
+
+def fields_from_key_values(result):
+    """Campi dalle coppie chiave-valore e dalle tabelle: {campo: (valore, sorgente)}"""
+    best = {}
+    for key, raw_value, source in _collect_pairs(result):
+        match = _match_key(key)
+        if not match:
+            continue
+        field, rank = match
+        if field in best and best[field][0] <= rank:
+            continue
+        value = _format_field(field, raw_value)
+        if value is not None:
+            best[field] = (rank, value, source)
+    return {field: (value, source) for field, (rank, value, source) in best.items()}
+
+
+def extract_document_fields(result, field_extractor=None):
+    """Campi strutturati di un AnalyzeResult: modello invoice, poi coppie chiave-valore e tabelle.
+
+    Ritorna (campi, sorgenti); i campi non trovati restano agli estrattori regex.
+    """
+    fields = {}
+    sources = {}
+
+    for field, value in fields_from_invoice(result).items():
+        fields[field] = value
+        sources[field] = 'invoice'
+
+    for field, (value, source) in fields_from_key_values(result).items():
+        if field not in fields:
+            fields[field] = value
+            sources[field] = source
+
+    # Nome del fornitore normalizzato sull'elenco noto (es. "Enel Energia S.p.A." -> ENEL)
+    if fields.get('supplier') and field_extractor:
+        fields['supplier'] = field_extractor.extract_supplier(fields['supplier']) or fields['supplier']
+
+    return fields, sources
@@ -0,0 +1,101 @@
+import os
+import gzip
+import json
+from azure.ai.formrecognizer import AnalyzeResult
+from azure.storage.blob import BlobServiceClient
+
+
+class LocalExtractionCache:
+    """Risultati OCR compressi su disco, uno per file"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json.gz")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Scrittura atomica: un lettore concorrente non vede mai un file a metà
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+class BlobExtractionCache:
+    """Risultati OCR compressi in un container di Azure Blob Storage"""
+
+    def __init__(self, connection_string, container_name):
+        self.container_client = BlobServiceClient.from_connection_string(
+            connection_string
+        ).get_container_client(container_name)
+        try:
+            self.container_client.create_container()
+        except Exception as e:
+            pass
+
+    def get(self, key):
+        try:
+            return self.container_client.get_blob_client(f"{key}.json.gz").download_blob().readall()
+        except Exception as e:
+            return None
+
+    def put(self, key, data):
+        self.container_client.get_blob_client(f"{key}.json.gz").upload_blob(data, overwrite=True)
+
+
+class ExtractionCache:
+    """Cache dei risultati grezzi di Form Recognizer, per modello e hash del PDF.
+
+    Permette di rieseguire l'estrazione dei campi sui risultati OCR già pagati,
+    senza richiamare Form Recognizer.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or self._default_backend()
+
+    @staticmethod
+    def _default_backend():
+        container_name = os.getenv('AZURE_EXTRACTION_CACHE_CONTAINER')
+        connection_string = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
+        if container_name and connection_string:
+            return BlobExtractionCache(connection_string, container_name)
+        return LocalExtractionCache(os.getenv(
+            'EXTRACTION_CACHE_DIR',
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extraction_cache')
+        ))
+
+    @staticmethod
+    def _key(model_id, content_hash):
+        return f"{model_id}/{content_hash}"
+
+    def get(self, content_hash, model_id='prebuilt-document'):
+        """Ritorna l'AnalyzeResult salvato o None"""
+        if not content_hash:
+            return None
+        try:
+            data = self.backend.get(self._key(model_id, content_hash))
+            if data is None:
+                return None
+            return AnalyzeResult.from_dict(json.loads(gzip.decompress(data)))
+        except Exception as e:
+            return None
+
+    def put(self, content_hash, result, model_id='prebuilt-document'):
+        """Salva l'AnalyzeResult compresso (gli errori di scrittura non bloccano l'estrazione)"""
+        if not content_hash:
+            return
+        try:
+            data = gzip.compress(json.dumps(result.to_dict(), default=str).encode('utf-8'))
+            self.backend.put(self._key(model_id, content_hash), data)
+        except Exception as e:
+            pass
@@ -0,0 +1,150 @@
+import os
+import time
+import pickle
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class LRUCacheBackend:
+    """Cache in memoria del processo con evizione LRU e scadenza (TTL)"""
+
+    def __init__(self, max_entries=1000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCacheBackend:
+    """Cache condivisa tra processi su un server compatibile Redis"""
+
+    def __init__(self, url, ttl=300, prefix='smartbills:file_index:'):
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        data = self.client.get(self.prefix + key)
+        return pickle.loads(data) if data else None
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(self.prefix + '*'))
+
+
+class FileIndex:
+    """Indice per utente dei file caricati, aggiornato ad ogni upload/eliminazione.
+
+    Con il backend in memoria ogni worker ha il proprio indice: un upload gestito da un altro
+    worker diventa visibile alla scadenza del TTL. Per un indice condiviso usare Redis.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or self._default_backend()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _default_backend():
+        ttl = int(os.getenv('FILE_INDEX_TTL', 300))
+        redis_url = os.getenv('FILE_INDEX_REDIS_URL')
+        if redis_url and redis is not None:
+            return RedisCacheBackend(redis_url, ttl=ttl)
+        return LRUCacheBackend(max_entries=int(os.getenv('FILE_INDEX_MAX_USERS', 1000)), ttl=ttl)
+
+    def get_index(self, user_folder, loader):
+        """Ritorna {'files', 'total_size'} dall'indice; se assente lo costruisce con loader()"""
+        index = self.backend.get(user_folder)
+        if index is not None:
+            self.hits += 1
+            return index
+
+        self.misses += 1
+        files = sorted(loader(), key=lambda x: x['upload_time'], reverse=True)
+        index = {
+            'files': files,
+            'total_size': sum(file['size'] for file in files)
+        }
+        self.backend.set(user_folder, index)
+        return index
+
+    def add_file(self, user_folder, file_info):
+        """Aggiunge (o sostituisce) un file nell'indice dell'utente, se già presente in cache"""
+        with self._lock:
+            index = self.backend.get(user_folder)
+            if index is None:
+                return
+            replaced = [f for f in index['files'] if f['name'] == file_info['name']]
+            files = [f for f in index['files'] if f['name'] != file_info['name']]
+            files.append(file_info)
+            files.sort(key=lambda x: x['upload_time'], reverse=True)
+            self.backend.set(user_folder, {
+                'files': files,
+                'total_size': index['total_size'] - sum(f['size'] for f in replaced) + file_info['size']
+            })
+
+    def remove_file(self, user_folder, filename):
+        """Rimuove un file dall'indice dell'utente, se già presente in cache"""
+        with self._lock:
+            index = self.backend.get(user_folder)
+            if index is None:
+                return
+            removed = [f for f in index['files'] if f['name'] == filename]
+            if not removed:
+                return
+            self.backend.set(user_folder, {
+                'files': [f for f in index['files'] if f['name'] != filename],
+                'total_size': index['total_size'] - sum(f['size'] for f in removed)
+            })
+
+    def invalidate(self, user_folder):
+        self.backend.delete(user_folder)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'cached_users': len(self.backend)
+        }
+
+
+file_index = FileIndex()
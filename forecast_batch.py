@@ -0,0 +1,131 @@
+"""Calcolo notturno delle previsioni di tutti gli utenti.
+
+Per ogni utente legge gli aggregati (ricostruiti dalla sua partizione se mancano),
+calcola in un pool di processi le previsioni di tutti i tipi di bolletta e del totale
+(molti utenti per matrice NumPy) e le salva come documento 'forecasts_<utente>'
+nel container degli aggregati, dove /bills/api/forecast le trova già pronte.
+"""
+import os
+import json
+from datetime import datetime
+from multiprocessing import Pool
+from bill_aggregates import apply_bill, empty_aggregates, all_monthly_series
+from bill_forecast import forecast_series, forecasts_id
+
+USERS_QUERY = "SELECT DISTINCT VALUE c.user_id FROM c"
+
+MIN_FORECAST_POINTS = 3
+
+
+def build_forecast_documents(users, months_ahead):
+    """Documenti delle previsioni per un blocco di utenti: [(user_id, versione dei dati, serie)].
+
+    Tutte le serie del blocco finiscono in un'unica chiamata vettoriale.
+    """
+    series_by_key = {}
+    for user_id, data_version, series_by_type in users:
+        for bill_type, series in series_by_type.items():
+            if len(series) >= MIN_FORECAST_POINTS:
+                series_by_key[(user_id, bill_type)] = series
+
+    forecasts = forecast_series(
+        series_by_key, months_ahead, bill_types={key: key[1] for key in series_by_key}
+    )
+
+    computed_at = datetime.now().isoformat()
+    documents = []
+    for user_id, data_version, series_by_type in users:
+        documents.append({
+            'id': forecasts_id(user_id),
+            'user_id': user_id,
+            'data_version': data_version,
+            'months_ahead': months_ahead,
+            'forecasts': {
+                bill_type: forecasts[(user_id, bill_type)]
+                for bill_type in series_by_type
+                if bill_type is not None and (user_id, bill_type) in forecasts
+            },
+            'total': forecasts.get((user_id, None)),
+            'computed_at': computed_at
+        })
+    return documents
+
+
+def _forecast_chunk(args):
+    users, months_ahead = args
+    return build_forecast_documents(users, months_ahead)
+
+
+def _user_entry(user_id, aggregates):
+    data_version = aggregates.get('_etag') or aggregates.get('version')
+    return user_id, data_version, all_monthly_series(aggregates)
+
+
+def iter_cosmos_users(processor, page_size=200):
+    """Utenti dal container delle bollette, con i loro aggregati (ricostruiti partizione per partizione se mancano)"""
+    user_ids = processor.container.query_items(
+        query=USERS_QUERY,
+        enable_cross_partition_query=True,
+        max_item_count=page_size
+    )
+    for user_id in user_ids:
+        aggregates = processor.get_user_aggregates(user_id)
+        if aggregates is not None:
+            yield _user_entry(user_id, aggregates)
+
+
+def iter_jsonl_users(path):
+    """Utenti da un export JSONL delle bollette: aggregati costruiti in streaming"""
+    aggregates_by_user = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            bill = json.loads(line)
+            aggregates = aggregates_by_user.get(bill['user_id'])
+            if aggregates is None:
+                aggregates = aggregates_by_user[bill['user_id']] = empty_aggregates(bill['user_id'])
+            apply_bill(aggregates, bill)
+
+    for user_id, aggregates in aggregates_by_user.items():
+        yield _user_entry(user_id, aggregates)
+
+
+def _chunks(users, chunk_size, months_ahead):
+    chunk = []
+    for user in users:
+        chunk.append(user)
+        if len(chunk) >= chunk_size:
+            yield chunk, months_ahead
+            chunk = []
+    if chunk:
+        yield chunk, months_ahead
+
+
+def precompute_forecasts(processor, input_path=None, output_path=None, workers=None,
+                         months_ahead=12, chunk_size=100, batch_size=50, page_size=200):
+    """Calcola e salva le previsioni di tutti gli utenti. Ritorna i contatori del job"""
+    # Import locale: bill_reprocessor importa a sua volta questo modulo per la CLI
+    from bill_reprocessor import BulkWriter
+
+    if not input_path and not processor.container:
+        raise RuntimeError('Cosmos DB non configurato: usa --input con un export JSONL')
+    if not output_path and not processor.aggregates_container:
+        raise RuntimeError('Cosmos DB non configurato: usa --output per scrivere su file')
+
+    if input_path:
+        users = iter_jsonl_users(input_path)
+    else:
+        users = iter_cosmos_users(processor, page_size)
+
+    stats = {'users': 0, 'forecasts': 0}
+    writer = BulkWriter(processor.aggregates_container, output_path, batch_size)
+    with Pool(processes=workers or os.cpu_count()) as pool:
+        for documents in pool.imap_unordered(_forecast_chunk, _chunks(users, chunk_size, months_ahead)):
+            for document in documents:
+                writer.add(document)
+                stats['users'] += 1
+                stats['forecasts'] += len(document['forecasts']) + (1 if document['total'] else 0)
+    writer.flush()
+
+    return stats
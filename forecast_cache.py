@@ -0,0 +1,82 @@
+import os
+import copy
+import itertools
+import threading
+from collections import OrderedDict
+from file_index import LRUCacheBackend
+
+
+class Uncached:
+    """Risultato di compute() da restituire senza memorizzarlo (es. previsione di ripiego dopo un errore)"""
+
+    def __init__(self, value):
+        self.value = value
+
+
+class ForecastCache:
+    """Memoizzazione di previsioni e trend per (tipo di calcolo, utente, parametri, versione dei dati).
+
+    La versione dei dati (ETag o versione degli aggregati) rende obsolete le voci calcolate
+    da altri processi; l'invalidazione esplicita dopo un salvataggio vale nel processo corrente.
+    """
+
+    def __init__(self, backend=None, max_users=None):
+        max_entries = int(os.getenv('FORECAST_CACHE_MAX_ENTRIES', 5000))
+        self.backend = backend or LRUCacheBackend(
+            max_entries=max_entries,
+            ttl=int(os.getenv('FORECAST_CACHE_TTL', 3600))
+        )
+        self.hits = 0
+        self.misses = 0
+        # Generazione per utente: cambiarla invalida tutte le sue voci senza doverle cercare.
+        # Limitata come l'LRU: un utente rimosso riceve una generazione mai usata, quindi
+        # le sue voci rimaste nel backend diventano irraggiungibili e scadono da sole
+        self.max_users = max_users or max_entries
+        self._generations = OrderedDict()
+        self._generation_counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _generation(self, user_id):
+        with self._lock:
+            generation = self._generations.get(user_id)
+            if generation is None:
+                generation = self._generations[user_id] = next(self._generation_counter)
+                while len(self._generations) > self.max_users:
+                    self._generations.popitem(last=False)
+            self._generations.move_to_end(user_id)
+            return generation
+
+    def _key(self, kind, user_id, params, data_version):
+        return (kind, user_id, self._generation(user_id), data_version) + tuple(params)
+
+    def get_or_compute(self, kind, user_id, params, data_version, compute):
+        """Ritorna il risultato in cache o lo calcola con compute() e lo memorizza (tranne se Uncached)"""
+        key = self._key(kind, user_id, params, data_version)
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return copy.deepcopy(value)
+
+        self.misses += 1
+        value = compute()
+        if isinstance(value, Uncached):
+            return value.value
+        if value is not None:
+            self.backend.set(key, value)
+        return copy.deepcopy(value)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._generations[user_id] = next(self._generation_counter)
+            self._generations.move_to_end(user_id)
+            while len(self._generations) > self.max_users:
+                self._generations.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'cached_entries': len(self.backend)
+        }
@@ -0,0 +1,346 @@
+"""Registro dei modelli di previsione.
+
+Ogni modello lavora su un SeriesBatch (tutte le serie insieme) con la stessa interfaccia:
+fit() stima i parametri di ogni colonna (dizionari serializzabili in JSON, memorizzabili
+per versione dei dati), predict() produce la matrice orizzonti x colonne degli importi.
+Con model='auto' il modello di ogni serie si sceglie con una validazione incrociata
+sugli ultimi mesi dello storico.
+"""
+import numpy as np
+from bill_forecast import (
+    SeriesBatch, ADVANCED_MIN_POINTS, series_means, future_months, build_forecasts,
+    linear_predictions, advanced_predictions, linear_forecasts, advanced_forecasts, forecast_series
+)
+
+SEASON_LENGTH = 12
+
+# Holt-Winters: griglia dei parametri di smorzamento provati per ogni serie (tutti in un'unica passata)
+HOLT_WINTERS_ALPHAS = (0.2, 0.4, 0.6, 0.8)
+HOLT_WINTERS_BETAS = (0.0, 0.1, 0.2)
+HOLT_WINTERS_GAMMAS = (0.1, 0.3, 0.5)
+HOLT_WINTERS_PHI = 0.95
+
+# Validazione incrociata per model='auto': ultime CV_FOLDS finestre di CV_HORIZON mesi.
+# Si parte dal modello avanzato (il migliore nel backtest a ogni lunghezza dello storico) e lo si
+# sostituisce solo con almeno CV_MIN_FOLDS finestre e un errore inferiore di almeno CV_MARGIN
+AUTO_BASELINE_MODEL = 'advanced'
+CV_HORIZON = 3
+CV_FOLDS = 4
+CV_MIN_FOLDS = 2
+CV_MARGIN = 0.1
+MIN_TRAIN_POINTS = 2
+
+
+class ForecastModel:
+    """Interfaccia dei modelli: parametri per colonna e importi previsti per tutte le colonne"""
+
+    name = None
+    label = None
+    min_points = MIN_TRAIN_POINTS
+
+    def fit(self, batch, bill_types=None):
+        """Parametri stimati per ogni colonna del batch"""
+        return [{} for _ in range(len(batch))]
+
+    def predict(self, batch, months_ahead, bill_types=None, params=None):
+        """Importi previsti (orizzonti x colonne)"""
+        raise NotImplementedError
+
+    def forecasts(self, batch, months_ahead, bill_types=None, params=None):
+        """Previsioni nel formato delle API, una per colonna"""
+        if params is None:
+            params = self.fit(batch, bill_types)
+        predicted = self.predict(batch, months_ahead, bill_types, params)
+        return build_forecasts(batch, predicted, self.label, 'media')
+
+
+class LinearModel(ForecastModel):
+    """Regressione lineare esistente: in forma chiusa, non ha parametri da memorizzare.
+
+    Come in generate_forecast, senza i fattori per tipo di bolletta.
+    """
+
+    name = 'linear'
+    label = 'Linear Regression'
+
+    def predict(self, batch, months_ahead, bill_types=None, params=None):
+        return linear_predictions(batch, months_ahead)
+
+    def forecasts(self, batch, months_ahead, bill_types=None, params=None):
+        return linear_forecasts(batch, months_ahead)
+
+
+class AdvancedModel(ForecastModel):
+    """Trend + EMA + stagionalità esistente: in forma chiusa, non ha parametri da memorizzare.
+
+    Funziona da 2 mesi in su; la soglia dei 6 mesi resta solo per la scelta predefinita.
+    """
+
+    name = 'advanced'
+    label = 'Advanced Local (Linear + EMA + Seasonal)'
+
+    def predict(self, batch, months_ahead, bill_types=None, params=None):
+        return advanced_predictions(batch, months_ahead, bill_types)
+
+    def forecasts(self, batch, months_ahead, bill_types=None, params=None):
+        return advanced_forecasts(batch, months_ahead, bill_types)
+
+
+class SeasonalNaiveModel(ForecastModel):
+    """Ogni mese futuro ripete l'ultimo importo dello stesso mese di calendario"""
+
+    name = 'seasonal_naive'
+    label = 'Seasonal Naive'
+    min_points = SEASON_LENGTH
+
+    def fit(self, batch, bill_types=None):
+        # Ultimo valore per mese di calendario (righe 1-12); la media per i mesi mai osservati
+        last_by_month = np.tile(series_means(batch), (13, 1))
+        columns = np.arange(len(batch))
+        for row in range(batch.amounts.shape[0]):
+            observed = batch.mask[row]
+            last_by_month[batch.calendar_months[row, observed], columns[observed]] = batch.amounts[row, observed]
+        return [{'seasonal': last_by_month[1:, column].tolist()} for column in columns]
+
+    def predict(self, batch, months_ahead, bill_types=None, params=None):
+        if params is None:
+            params = self.fit(batch, bill_types)
+        seasonal = np.array([p['seasonal'] for p in params]).T
+        _, months = future_months(batch, months_ahead)
+        return seasonal[months - 1, np.arange(len(batch))]
+
+
+class HoltWintersModel(ForecastModel):
+    """Holt-Winters (livello, trend smorzato, stagionalità moltiplicativa per mese di calendario).
+
+    Servono due anni di storico per inizializzare la stagionalità; alpha, beta e gamma si
+    scelgono per ogni serie sulla griglia che minimizza l'errore relativo a un passo.
+    """
+
+    name = 'holt_winters'
+    label = 'Holt-Winters (triple exponential smoothing)'
+    min_points = 2 * SEASON_LENGTH
+
+    def fit(self, batch, bill_types=None):
+        values, months = _left_aligned(batch)
+        columns = len(batch)
+        grid = [(a, b, g) for a in HOLT_WINTERS_ALPHAS for b in HOLT_WINTERS_BETAS for g in HOLT_WINTERS_GAMMAS]
+
+        # Tutte le combinazioni della griglia come colonne in più: una sola ricorsione
+        alpha, beta, gamma = (np.repeat(np.array(p, dtype=float), columns) for p in zip(*grid))
+        lengths = np.tile(batch.lengths, len(grid))
+        level, trend, seasonal, errors = _holt_winters_smooth(
+            np.tile(values, (1, len(grid))), np.tile(months, (1, len(grid))), lengths, alpha, beta, gamma
+        )
+
+        best = errors.reshape(len(grid), columns).argmin(axis=0) * columns + np.arange(columns)
+        return [{
+            'alpha': float(alpha[i]),
+            'beta': float(beta[i]),
+            'gamma': float(gamma[i]),
+            'phi': HOLT_WINTERS_PHI,
+            'level': float(level[i]),
+            'trend': float(trend[i]),
+            'seasonal': seasonal[:, i].tolist()
+        } for i in best]
+
+    def predict(self, batch, months_ahead, bill_types=None, params=None):
+        if params is None:
+            params = self.fit(batch, bill_types)
+        level = np.array([p['level'] for p in params])
+        trend = np.array([p['trend'] for p in params])
+        seasonal = np.array([p['seasonal'] for p in params]).T
+
+        # Trend smorzato: somma di phi^1..phi^h
+        damped = np.cumsum(HOLT_WINTERS_PHI ** np.arange(1, months_ahead + 1))[:, None]
+        _, months = future_months(batch, months_ahead)
+        return np.maximum((level + trend * damped) * seasonal[months - 1, np.arange(len(batch))], 0)
+
+
+def _left_aligned(batch):
+    """Importi e mesi di calendario allineati a sinistra (riga 0 = primo mese di ogni serie)"""
+    rows = batch.amounts.shape[0]
+    start = rows - batch.lengths
+    index = np.minimum(start[None, :] + np.arange(rows)[:, None], rows - 1)
+    columns = np.arange(len(batch))
+    valid = np.arange(rows)[:, None] < batch.lengths[None, :]
+    return (np.where(valid, batch.amounts[index, columns], np.nan),
+            np.where(valid, batch.calendar_months[index, columns], 1))
+
+
+def _holt_winters_smooth(values, months, lengths, alpha, beta, gamma, phi=HOLT_WINTERS_PHI):
+    """Ricorsione di Holt-Winters su tutte le colonne: stato finale ed errore relativo a un passo"""
+    columns = values.shape[1]
+    first_year = values[:SEASON_LENGTH]
+    second_year = values[SEASON_LENGTH:2 * SEASON_LENGTH]
+
+    # Stagionalità iniziale: media dei due anni per mese di calendario rispetto alla media complessiva
+    two_years = values[:2 * SEASON_LENGTH]
+    two_years_months = months[:2 * SEASON_LENGTH]
+    overall = two_years.mean(axis=0)
+    seasonal = np.ones((SEASON_LENGTH, columns))
+    for month in range(1, SEASON_LENGTH + 1):
+        selected = two_years_months == month
+        counts = selected.sum(axis=0)
+        sums = np.where(selected, two_years, 0.0).sum(axis=0)
+        seasonal[month - 1] = np.where(counts > 0, sums / np.maximum(counts, 1) / overall, 1.0)
+
+    column_index = np.arange(columns)
+    level = (first_year / seasonal[months[:SEASON_LENGTH] - 1, column_index]).mean(axis=0)
+    trend = (second_year.mean(axis=0) - first_year.mean(axis=0)) / SEASON_LENGTH
+
+    errors = np.zeros(columns)
+    for t in range(SEASON_LENGTH, values.shape[0]):
+        active = t < lengths
+        y = np.where(active, values[t], 1.0)
+        month_index = months[t] - 1
+        season = seasonal[month_index, column_index]
+
+        expected = (level + phi * trend) * season
+        errors += np.where(active, ((y - expected) / y) ** 2, 0.0)
+
+        new_level = np.maximum(alpha * y / season + (1 - alpha) * (level + phi * trend), 1e-9)
+        new_trend = beta * (new_level - level) + (1 - beta) * phi * trend
+        new_season = gamma * y / new_level + (1 - gamma) * season
+
+        level = np.where(active, new_level, level)
+        trend = np.where(active, new_trend, trend)
+        seasonal[month_index, column_index] = np.where(active, new_season, season)
+    return level, trend, seasonal, errors
+
+
+MODELS = {}
+
+
+def register_model(model):
+    MODELS[model.name] = model
+    return model
+
+
+for _model in (LinearModel(), AdvancedModel(), SeasonalNaiveModel(), HoltWintersModel()):
+    register_model(_model)
+
+AUTO_MODEL = 'auto'
+
+
+def model_names():
+    return list(MODELS) + [AUTO_MODEL]
+
+
+def get_model(name):
+    if name not in MODELS:
+        raise ValueError(f"Modello di previsione sconosciuto: {name} (disponibili: {', '.join(model_names())})")
+    return MODELS[name]
+
+
+def default_model_name(length):
+    """Scelta predefinita di generate_forecast: avanzato da 6 mesi di storico, lineare prima"""
+    return 'advanced' if length >= ADVANCED_MIN_POINTS else 'linear'
+
+
+def select_models(series_by_key, bill_types=None, horizon=CV_HORIZON, folds=CV_FOLDS):
+    """Modello con il minor errore percentuale sugli ultimi mesi di ogni serie: {chiave: nome}.
+
+    Ogni serie usa le ultime `folds` finestre di `horizon` mesi che lasciano almeno
+    MIN_TRAIN_POINTS mesi di addestramento; concorrono solo i modelli che hanno storico
+    sufficiente per tutte le finestre, così il confronto avviene sugli stessi mesi.
+    Le serie con meno di CV_MIN_FOLDS finestre restano su AUTO_BASELINE_MODEL, che cede
+    il posto solo a un modello che sbaglia almeno CV_MARGIN in meno.
+    Tutte le finestre di un modello sono calcolate in un'unica chiamata vettoriale.
+    """
+    bill_types = bill_types or {}
+    series_folds = {}
+    for key, series in series_by_key.items():
+        usable = min(folds, (len(series) - MIN_TRAIN_POINTS) // horizon)
+        if usable >= CV_MIN_FOLDS:
+            series_folds[key] = usable
+
+    errors = {}
+    for name, model in MODELS.items():
+        windows = []
+        for key, usable in series_folds.items():
+            series = series_by_key[key]
+            if len(series) - usable * horizon < model.min_points:
+                continue
+            for fold in range(1, usable + 1):
+                origin = len(series) - fold * horizon
+                windows.append((key, series[:origin], series[origin:origin + horizon]))
+        if not windows:
+            continue
+
+        batch = SeriesBatch([train for _, train, _ in windows])
+        types = [bill_types.get(key, key) for key, _, _ in windows]
+        predicted = model.predict(batch, horizon, types)
+        actual = np.array([[amount for _, amount in test] for _, _, test in windows]).T
+        window_errors = (np.abs(predicted - actual) / actual).mean(axis=0)
+
+        for (key, _, _), error in zip(windows, window_errors):
+            errors.setdefault(key, {}).setdefault(name, []).append(error)
+
+    chosen = {}
+    for key, series in series_by_key.items():
+        default = AUTO_BASELINE_MODEL
+        chosen[key] = default
+        if key not in errors:
+            continue
+        # Su poche finestre la validazione è rumorosa: si cambia modello solo con un vantaggio netto
+        mean_errors = {name: np.mean(model_errors) for name, model_errors in errors[key].items()}
+        best = min(mean_errors, key=mean_errors.get)
+        if mean_errors[best] < mean_errors.get(default, np.inf) * (1 - CV_MARGIN):
+            chosen[key] = best
+    return chosen
+
+
+def fit_series(series_by_key, model_name, bill_types=None):
+    """Modello e parametri stimati per ogni serie: {chiave: {'model': nome, 'params': {...}}}.
+
+    Il risultato dipende solo dai dati: si può memorizzare per versione dei dati e riusare
+    per qualunque orizzonte. Le serie troppo corte per il modello richiesto usano la scelta predefinita.
+    """
+    bill_types = bill_types or {}
+    if model_name == AUTO_MODEL:
+        chosen = select_models(series_by_key, bill_types)
+    else:
+        model = get_model(model_name)
+        chosen = {
+            key: model_name if len(series) >= model.min_points else default_model_name(len(series))
+            for key, series in series_by_key.items()
+        }
+
+    fitted = {}
+    for name in set(chosen.values()):
+        keys = [key for key in series_by_key if chosen[key] == name]
+        batch = SeriesBatch([series_by_key[key] for key in keys])
+        params = MODELS[name].fit(batch, [bill_types.get(key, key) for key in keys])
+        fitted.update({key: {'model': name, 'params': p} for key, p in zip(keys, params)})
+    return fitted
+
+
+def forecast_with_model(series_by_key, months_ahead, model_name=None, bill_types=None, fitted=None):
+    """Previsioni per più serie con il modello richiesto: {chiave: previsione}.
+
+    Senza modello vale la scelta predefinita per lunghezza dello storico (forecast_series);
+    `fitted` sono i parametri di fit_series, se già memorizzati.
+    """
+    if model_name is None:
+        return forecast_series(series_by_key, months_ahead, bill_types)
+
+    bill_types = bill_types or {}
+    series_by_key = {key: series for key, series in series_by_key.items() if len(series) >= MIN_TRAIN_POINTS}
+    if fitted is None:
+        fitted = fit_series(series_by_key, model_name, bill_types)
+
+    forecasts = {}
+    for name in set(fit['model'] for fit in fitted.values()):
+        keys = [key for key in series_by_key if key in fitted and fitted[key]['model'] == name]
+        if not keys:
+            continue
+        batch = SeriesBatch([series_by_key[key] for key in keys])
+        types = [bill_types.get(key, key) for key in keys]
+        params = [fitted[key]['params'] for key in keys]
+        for key, forecast in zip(keys, MODELS[name].forecasts(batch, months_ahead, types, params)):
+            forecast['model'] = name
+            if model_name == AUTO_MODEL:
+                forecast['model_selection'] = 'cross_validation'
+            forecasts[key] = forecast
+    return forecasts
@@ -0,0 +1,268 @@
+import os
+import json
+import uuid
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+
+class RetryJob(Exception):
+    """Sollevata da un handler per rimettere in coda il job dopo 'delay' secondi"""
+
+    def __init__(self, message, delay=30):
+        super().__init__(message)
+        self.delay = delay
+
+
+class JobQueue:
+    """Coda di job in background persistita su SQLite (funziona anche senza Azure)"""
+
+    def __init__(self, db_path=None, workers=None, poll_interval=1.0, lease_seconds=None, max_attempts=5):
+        self.db_path = db_path or os.getenv(
+            'JOBS_DB_PATH', os.path.join(tempfile.gettempdir(), 'smartbills_jobs.db')
+        )
+        self.workers = workers or int(os.getenv('JOBS_WORKERS', 2))
+        self.poll_interval = poll_interval
+        # Un job 'running' senza heartbeat da più di lease secondi è di un processo morto
+        self.lease = timedelta(seconds=lease_seconds or int(os.getenv('JOBS_LEASE_SECONDS', 120)))
+        self.max_attempts = max_attempts
+
+        self._handlers = {}
+        self._reset_process_state()
+
+        self._init_db()
+
+    def _reset_process_state(self):
+        # Thread, eventi e lock non sopravvivono a un fork (es. gunicorn --preload): ogni processo ha i suoi
+        self._pid = os.getpid()
+        self._threads = []
+        self._running = set()
+        self._running_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def _connect(self):
+        # Una connessione per operazione: sqlite3 non condivide connessioni tra thread
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    user_id TEXT,
+                    status TEXT NOT NULL,
+                    payload TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at TEXT NOT NULL,
+                    started_at TEXT,
+                    finished_at TEXT
+                )
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)')
+
+            # Colonne per i tentativi ripetuti, aggiunte anche ai database già esistenti
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            if 'attempts' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            if 'available_at' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN available_at TEXT')
+            if 'last_error' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN last_error TEXT')
+            if 'heartbeat_at' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN heartbeat_at TEXT')
+        finally:
+            conn.close()
+
+    def register(self, kind, handler):
+        """Registra la funzione che esegue i job di un certo tipo"""
+        self._handlers[kind] = handler
+
+    def enqueue(self, kind, payload, user_id=None):
+        """Accoda un job e ritorna subito il suo id"""
+        job_id = uuid.uuid4().hex
+        conn = self._connect()
+        try:
+            conn.execute(
+                'INSERT INTO jobs (id, kind, user_id, status, payload, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, kind, user_id, 'queued', json.dumps(payload), datetime.now().isoformat())
+            )
+        finally:
+            conn.close()
+
+        self.start()
+        self._wakeup.set()
+        return job_id
+
+    def get_job(self, job_id):
+        """Ritorna lo stato di un job o None se non esiste"""
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        finally:
+            conn.close()
+
+        if not row:
+            return None
+
+        return {
+            'id': row['id'],
+            'kind': row['kind'],
+            'user_id': row['user_id'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'last_error': row['last_error'],
+            'created_at': row['created_at'],
+            'started_at': row['started_at'],
+            'finished_at': row['finished_at']
+        }
+
+    def start(self):
+        """Avvia i worker (una sola volta per processo, anche dopo un fork)"""
+        if self._pid != os.getpid():
+            self._reset_process_state()
+        with self._start_lock:
+            if self._threads:
+                return
+            self._requeue_stale_jobs()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._heartbeat_loop, name='job-heartbeat', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _requeue_stale_jobs(self):
+        # Solo i job con lease scaduta (processo morto) tornano in coda, non quelli di altri worker attivi
+        cutoff = (datetime.now() - self.lease).isoformat()
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL, heartbeat_at = NULL "
+                "WHERE status = 'running' AND COALESCE(heartbeat_at, started_at) < ?",
+                (cutoff,)
+            )
+        finally:
+            conn.close()
+
+    def _heartbeat_loop(self):
+        # Rinnova la lease dei job in esecuzione in questo processo e recupera quelli dei processi morti
+        interval = self.lease.total_seconds() / 4
+        while not self._stop.wait(interval):
+            with self._running_lock:
+                running = list(self._running)
+            try:
+                if running:
+                    conn = self._connect()
+                    try:
+                        conn.executemany(
+                            "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = 'running'",
+                            [(datetime.now().isoformat(), job_id) for job_id in running]
+                        )
+                    finally:
+                        conn.close()
+                self._requeue_stale_jobs()
+            except Exception as e:
+                pass
+
+    def _claim_next(self):
+        """Prende in carico il job più vecchio in coda (atomico anche tra più processi)"""
+        conn = self._connect()
+        try:
+            now = datetime.now().isoformat()
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                "SELECT id, kind, payload, attempts FROM jobs WHERE status = 'queued' "
+                "AND (available_at IS NULL OR available_at <= ?) ORDER BY created_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            if not row:
+                conn.execute('COMMIT')
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, heartbeat_at = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (now, now, row['id'])
+            )
+            conn.execute('COMMIT')
+            return row['id'], row['kind'], json.loads(row['payload'] or '{}'), row['attempts'] + 1
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def _finish(self, job_id, status, result=None, error=None):
+        conn = self._connect()
+        try:
+            conn.execute(
+                'UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?',
+                (status, json.dumps(result, default=str) if result is not None else None,
+                 error, datetime.now().isoformat(), job_id)
+            )
+        finally:
+            conn.close()
+
+    def _retry_later(self, job_id, delay, error):
+        # Il motivo del nuovo tentativo va in last_error: 'error' resta vuoto finché il job non fallisce
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', error = NULL, last_error = ?, available_at = ? WHERE id = ?",
+                (error, (datetime.now() + timedelta(seconds=delay)).isoformat(), job_id)
+            )
+        finally:
+            conn.close()
+
+    def _worker_loop(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim_next()
+            except Exception as e:
+                job = None
+
+            if not job:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            job_id, kind, payload, attempts = job
+            handler = self._handlers.get(kind)
+            if not handler:
+                self._finish(job_id, 'failed', error=f"Nessun handler registrato per '{kind}'")
+                continue
+
+            with self._running_lock:
+                self._running.add(job_id)
+            try:
+                # L'handler sa se è l'ultimo tentativo (es. per ripulire i file temporanei)
+                result = handler(payload, attempts >= self.max_attempts)
+                self._finish(job_id, 'completed', result=result)
+            except RetryJob as e:
+                if attempts < self.max_attempts:
+                    self._retry_later(job_id, e.delay, str(e))
+                else:
+                    self._finish(job_id, 'failed', error=str(e))
+            except Exception as e:
+                self._finish(job_id, 'failed', error=str(e))
+            finally:
+                with self._running_lock:
+                    self._running.discard(job_id)
+
+
+job_queue = JobQueue()
@@ -0,0 +1,69 @@
+from collections import deque
+
+
+class KeywordMatcher:
+    """Automa di Aho-Corasick: trova tutte le parole chiave nel testo in un'unica passata lineare"""
+
+    def __init__(self, keywords):
+        # Stato 0 = radice. Per ogni stato: transizioni, link di fallimento e parole riconosciute
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [frozenset()]
+
+        for keyword in keywords:
+            self._add(keyword)
+        self._build()
+
+    def _add(self, keyword):
+        if not keyword:
+            return
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(frozenset())
+            state = next_state
+        self._output[state] = self._output[state] | {keyword}
+
+    def _build(self):
+        """Calcola i link di fallimento in ampiezza e completa le transizioni dell'automa"""
+        queue = deque(self._goto[0].values())
+        order = []
+        while queue:
+            state = queue.popleft()
+            order.append(state)
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+
+                self._fail[next_state] = fail
+                self._output[next_state] = self._output[next_state] | self._output[fail]
+
+        # Automa deterministico: ogni stato eredita le transizioni del suo link di fallimento,
+        # così la scansione fa un solo lookup per carattere. I caratteri fuori dall'alfabeto
+        # delle parole chiave riportano sempre alla radice.
+        self._delta = [dict(transitions) for transitions in self._goto]
+        for state in order:
+            for char, next_state in self._delta[self._fail[state]].items():
+                self._delta[state].setdefault(char, next_state)
+
+    def find_all(self, text):
+        """Ritorna l'insieme delle parole chiave presenti nel testo (anche sovrapposte)"""
+        delta, output = self._delta, self._output
+        found = set()
+        state = 0
+
+        for char in text:
+            state = delta[state].get(char, 0)
+            if output[state]:
+                found |= output[state]
+
+        return found
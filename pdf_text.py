@@ -0,0 +1,46 @@
+import io
+import os
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+# Sotto questa media di caratteri per pagina il PDF è considerato scansionato (solo immagini)
+MIN_CHARS_PER_PAGE = int(os.getenv('TEXT_LAYER_MIN_CHARS_PER_PAGE', 100))
+
+
+def count_pages(pdf_bytes):
+    """Numero di pagine del PDF o None se non determinabile"""
+    if PdfReader is None or not pdf_bytes:
+        return None
+    try:
+        return len(PdfReader(io.BytesIO(pdf_bytes)).pages)
+    except Exception as e:
+        return None
+
+
+def extract_text_layer(pdf_bytes, max_pages=None, min_chars_per_page=MIN_CHARS_PER_PAGE):
+    """Testo incorporato nel PDF (PDF generati digitalmente), senza OCR.
+
+    Ritorna None se pypdf non è installato, il PDF non è leggibile o il testo è
+    troppo scarso per essere affidabile (PDF scansionato).
+    """
+    if PdfReader is None or not pdf_bytes:
+        return None
+
+    try:
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        pages = reader.pages[:max_pages] if max_pages else reader.pages
+        texts = [page.extract_text() or '' for page in pages]
+    except Exception as e:
+        return None
+
+    if not texts:
+        return None
+
+    # Stessa forma del testo di Form Recognizer: righe separate da spazi
+    full_text = " ".join(line.strip() for text in texts for line in text.splitlines() if line.strip())
+    if len(full_text) < min_chars_per_page * len(texts):
+        return None
+    return full_text